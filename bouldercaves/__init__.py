@@ -1,8 +1,9 @@
 import sys
 import os
-try:
-    from PIL import Image
-except ImportError:
+import importlib.util
+from . import startup     # noqa: F401   (starts the startup profiler's clock, before the other modules are imported)
+# only check that pillow is there, it is imported when it's actually needed
+if importlib.util.find_spec("PIL") is None:
     import tkinter
     import tkinter.messagebox
     r = tkinter.Tk()
@@ -19,16 +19,22 @@ Written by Irmen de Jong (irmen@razorvine.net)
 License: GNU GPL 3.0, see LICENSE
 """
 
+import io
+import sys
 import pkgutil
 import time
-import tempfile
 import os
-import subprocess
-from typing import Union, Dict, Tuple
-from .synthplayer import streaming, params as synth_params
+import json
+import shutil
+import struct
+import threading
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+from typing import Union, Dict, Tuple, List, Optional, Any
+from .synthplayer import streaming, playback, params as synth_params
 from .synthplayer.sample import Sample
 from .synthplayer.playback import Output, best_api
-from . import user_data_dir
+from . import user_data_dir, tracing, diskcache
 
 
 __all__ = ["init_audio", "play_sample", "silence_audio", "shutdown_audio"]
@@ -49,14 +55,65 @@ def prepare_oggdec_exe():
 
 # audio parameters
 synth_params.norm_samplerate = 44100
-try:
-    if not prepare_oggdec_exe():
-        subprocess.call("oggdec", stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    streaming.AudiofileToWavStream.ffprobe_executable = ""  # force use of oggdec instead of ffmpeg
-    streaming.AudiofileToWavStream.ffmpeg_executable = ""  # force use of oggdec instead of ffmpeg
-except IOError:
-    # no oggdec, stick with ffmpeg
-    pass
+decoder_probed = False
+decoder_probe_lock = threading.Lock()
+probe_cache_file = user_data_dir + "audioprobe.json"
+
+
+def probe_decoder() -> None:
+    # Checks (once) if the oggdec decoder is available. If so, it is used instead of ffmpeg.
+    # This is only done when sound files actually have to be decoded.
+    # The executable is looked up on the path, rather than by launching it.
+    global decoder_probed
+    with decoder_probe_lock:
+        if decoder_probed:
+            return
+        use_oggdec = prepare_oggdec_exe()
+        if not use_oggdec:
+            oggdec = shutil.which("oggdec")
+            if oggdec:
+                streaming.AudiofileToWavStream.oggdec_executable = oggdec
+                use_oggdec = True
+        if use_oggdec:
+            streaming.AudiofileToWavStream.ffprobe_executable = ""  # force use of oggdec instead of ffmpeg
+            streaming.AudiofileToWavStream.ffmpeg_executable = ""  # force use of oggdec instead of ffmpeg
+        decoder_probed = True
+
+
+def probe_fingerprint() -> Dict[str, Any]:
+    # Everything the audio probe result depends on. Cheap to determine: no processes are started
+    # and no modules are imported, only some files are looked up. The mtime of a module
+    # stands in for its version, because asking for the version means importing it.
+    def file_stamp(path: Optional[str]) -> List[Any]:
+        try:
+            return [path, os.path.getmtime(path)] if path else []
+        except OSError:
+            return []
+    fingerprint = {
+        "python": sys.version,
+        "platform": sys.platform,
+        "device_env": os.environ.get("PY_SYNTHPLAYER_AUDIO_DEVICE", "")
+    }   # type: Dict[str, Any]
+    for module in ("sounddevice", "pyaudio"):
+        spec = importlib.util.find_spec(module)
+        fingerprint[module] = file_stamp(spec.origin if spec else None)
+    return fingerprint
+
+
+def load_probe() -> Optional[Dict[str, Any]]:
+    try:
+        with open(probe_cache_file, "rt") as f:
+            probe = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return probe if probe.get("fingerprint") == probe_fingerprint() else None
+
+
+def forget_probe() -> None:
+    try:
+        os.remove(probe_cache_file)
+    except OSError:
+        pass
 
 
 samples = {}    # type: Dict[str, Union[str, Sample]]
@@ -66,41 +123,172 @@ class SoundEngine:
     def __init__(self, samples_to_load: Dict[str, Tuple[Union[str, Sample], int]]) -> None:
         global samples
         samples.clear()
-        self.output = Output(mixing="mix")
-        if any(isinstance(smp, str) for smp, _ in samples_to_load.values()):
+        self.sample_limits = {}     # type: Dict[str, int]
+        self.pending_repeats = {}   # type: Dict[str, float]
+        self.pending_lock = threading.Lock()
+        try:
+            self.output = Output(mixing="mix")
+        except Exception:
+            forget_probe()      # the audio setup may have changed, probe it again next time
+            raise
+        if tracing.enabled:
+            self.output.audio_api.mixer.chunk_mixed_callback = \
+                lambda start_time, end_time: tracing.add_span("mix chunk", "audio", start_time, end_time)
+        sample_files = {name: smp for name, (smp, _) in samples_to_load.items() if isinstance(smp, str)}
+        loaded = {}     # type: Dict[str, Sample]
+        if sample_files:
             print("Loading sound files...")
-        for name, (filename, max_simultaneously) in samples_to_load.items():
-            if isinstance(filename, Sample):
-                samples[name] = filename
-            else:
-                data = pkgutil.get_data(__name__, "sounds/" + filename)
-                if data:
-                    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".ogg")
-                    try:
-                        tmp.write(data)
-                        tmp.close()
-                        samples[name] = Sample(streaming.AudiofileToWavStream(tmp.name), name).stereo()
-                    finally:
-                        os.remove(tmp.name)
-                else:
-                    raise SystemExit("corrupt package; sound data is missing")
-            self.output.set_sample_play_limit(name, max_simultaneously)
+            loaded = load_samples(sample_files)
+        for name, (smp, max_simultaneously) in samples_to_load.items():
+            self.add_sample(name, loaded[name] if isinstance(smp, str) else smp, max_simultaneously)
         print("Sound API initialized:", self.output.audio_api)
 
+    def add_sample(self, name: str, sample: Sample, max_simultaneously: int) -> None:
+        # samples can be added while the game is already running (they're loaded in the background)
+        self.output.set_sample_play_limit(name, max_simultaneously)
+        self.sample_limits[name] = max_simultaneously
+        with self.pending_lock:
+            samples[name] = sample
+            pending_after = self.pending_repeats.pop(name, None)
+        if pending_after is not None:
+            self.output.play_sample(sample, True, pending_after)
+
     def play_sample(self, samplename, repeat=False, after=0.0):
-        self.output.play_sample(samples[samplename], repeat, after)
+        sample = samples.get(samplename)
+        if sample is None and repeat:
+            # A sample that is still being loaded is not played, unless it repeats: otherwise a
+            # background sound (such as the amoeba) would be missing for the rest of the cave.
+            # It is started as soon as it has been loaded.
+            with self.pending_lock:
+                sample = samples.get(samplename)
+                if sample is None:
+                    self.pending_repeats[samplename] = after
+        if sample is not None:
+            self.output.play_sample(sample, repeat, after)
 
     def silence(self, sid_or_name=None):
         if sid_or_name:
+            if isinstance(sid_or_name, str):
+                with self.pending_lock:
+                    self.pending_repeats.pop(sid_or_name, None)
             self.output.stop_sample(sid_or_name)
         else:
+            with self.pending_lock:
+                self.pending_repeats.clear()
             self.output.silence()
 
+    def set_voice_budget(self, max_voices: int, priorities: Dict[str, int]) -> None:
+        # limits the number of samples that are mixed at the same time (0=unlimited).
+        # when more are played, the ones with the lowest priority are stopped first.
+        mixer = self.output.audio_api.mixer
+        mixer.max_voices = max_voices
+        for name, priority in priorities.items():
+            mixer.set_priority(name, priority)
+
+    def play_batch(self, events: List[Tuple[str, Optional[str], bool, float]]) -> None:
+        # the whole batch is handed to the mixer at once, so the sounds all start in the same chunk
+        mixer = self.output.audio_api.mixer
+        mixer.begin_batch()
+        try:
+            for event, name, repeat, after in events:
+                if event == "play":
+                    self.play_sample(name, repeat, after)
+                else:
+                    self.silence(name)
+        finally:
+            mixer.end_batch()
+
     def close(self):
         self.output.close()
 
 
-sound_engine = None
+def load_sample(name: str, filename: str) -> Sample:
+    # Loads a sound file from the package. The decoded pcm data is cached on disk, keyed by the content
+    # of the sound file and the output format, so the (slow) decoding is only done the first time.
+    with tracing.span("load sample " + name, "audio"):
+        data = pkgutil.get_data(__name__, "sounds/" + filename)
+        if not data:
+            raise SystemExit("corrupt package; sound data is missing")
+        key = diskcache.make_key(data, synth_params.norm_samplerate, synth_params.norm_samplewidth, synth_params.norm_nchannels)
+        cached = diskcache.load("pcm", key)
+        if cached:
+            samplerate, samplewidth, nchannels = struct.unpack("<III", cached[0])
+            return Sample.from_raw_frames(cached[1], samplewidth, samplerate, nchannels, name)
+        sample = decode_sample(name, data)
+        header = struct.pack("<III", sample.samplerate, sample.samplewidth, sample.nchannels)
+        diskcache.store("pcm", key, [header, sample.view_frame_data()])
+        return sample
+
+
+def sample_bank_key(sample_files: Dict[str, str]) -> str:
+    # the key of a sample bank is made from the names and contents of all sound files, and the output format
+    parts = []   # type: List[Union[str, bytes, int]]
+    for name, filename in sorted(sample_files.items()):
+        parts.extend((name, pkgutil.get_data(__name__, "sounds/" + filename) or b""))
+    parts.extend((synth_params.norm_samplerate, synth_params.norm_samplewidth, synth_params.norm_nchannels))
+    return diskcache.make_key(*parts)
+
+
+def load_sample_bank(key: str) -> Optional[Dict[str, Sample]]:
+    # The sample bank is a single cache file with an index and the pcm data of all samples.
+    # It is memory mapped and the samples directly use slices of it, so loading it costs next to nothing.
+    blobs = diskcache.load_mapped("samplebank", key)
+    if not blobs:
+        return None
+    index = json.loads(bytes(blobs[0]).decode("utf-8"))
+    if len(index) != len(blobs) - 1:
+        return None
+    return {name: Sample.from_frame_view(frames, samplewidth, samplerate, nchannels, name)
+            for (name, samplerate, samplewidth, nchannels), frames in zip(index, blobs[1:])}
+
+
+def store_sample_bank(key: str, bank: Dict[str, Sample]) -> None:
+    index = [[name, smp.samplerate, smp.samplewidth, smp.nchannels] for name, smp in bank.items()]
+    diskcache.store("samplebank", key, [json.dumps(index).encode("utf-8")] + [smp.view_frame_data() for smp in bank.values()])
+
+
+def load_samples(sample_files: Dict[str, str]) -> Dict[str, Sample]:
+    # Loads all the sound files concurrently; each decoder is a separate process,
+    # so the total time is about that of the slowest sample instead of the sum of all of them.
+    with ThreadPoolExecutor(max_workers=min(8, (os.cpu_count() or 1) + 2)) as pool:
+        futures = {name: pool.submit(load_sample, name, filename) for name, filename in sample_files.items()}
+        return {name: future.result() for name, future in futures.items()}
+
+
+def decode_sample(name: str, data: bytes) -> Sample:
+    probe_decoder()
+    wav = io.BytesIO(streaming.AudiofileToWavStream.decode_bytes(data))
+    wav.name = name     # type: ignore
+    return Sample(wav, name).stereo()
+
+
+class SilentSoundEngine:
+    # sound engine that doesn't load or play anything, for running the game logic headless
+    sample_limits = {}      # type: Dict[str, int]
+
+    def play_sample(self, samplename, repeat=False, after=0.0):
+        pass
+
+    def play_batch(self, events):
+        pass
+
+    def set_voice_budget(self, max_voices, priorities):
+        pass
+
+    def silence(self, sid_or_name=None):
+        pass
+
+    def close(self):
+        pass
+
+
+sound_engine = None     # type: Any   # a SoundEngine or a SilentSoundEngine, once initialized
+
+
+def init_silent_audio() -> SilentSoundEngine:
+    global sound_engine
+    sound_engine = SilentSoundEngine()
+    return sound_engine
 
 
 def init_audio(samples_to_load) -> SoundEngine:
@@ -109,21 +297,116 @@ def init_audio(samples_to_load) -> SoundEngine:
     return sound_engine
 
 
+class SoundEvents:
+    """
+    Collects the sound requests made during one game logic frame, to pass them to the sound engine
+    all at once at the end of the frame. Duplicates are collapsed: a sample is started at most as many
+    times per frame as it may play simultaneously, and a sample that is started and silenced again
+    in the same frame isn't started at all. (Big rockfalls otherwise flood the mixer with
+    play requests that it would reject anyway.)
+    """
+    def __init__(self) -> None:
+        self.collecting = False
+        self.events = []    # type: List[Tuple[str, Optional[str], bool, float]]
+        self.play_counts = {}   # type: Dict[str, int]
+        self.requests = self.collapsed = 0
+
+    def play(self, name: str, repeat: bool, after: float) -> None:
+        self.requests += 1
+        limit = 1 if repeat else sound_engine.sample_limits.get(name, 9999999)
+        count = self.play_counts.get(name, 0)
+        if count >= limit:
+            self.collapsed += 1
+            return
+        self.play_counts[name] = count + 1
+        self.events.append(("play", name, repeat, after))
+
+    def silence(self, name: Optional[str]) -> None:
+        self.requests += 1
+        if name:
+            if self.play_counts.pop(name, 0):
+                self.events = [event for event in self.events if event[1] != name or event[0] != "play"]
+            if ("silence", name, False, 0.0) in self.events:
+                self.collapsed += 1
+                return
+        else:
+            self.play_counts.clear()
+            self.events.clear()
+        self.events.append(("silence", name, False, 0.0))
+
+    def begin(self) -> None:
+        self.collecting = True
+
+    def end(self) -> None:
+        self.collecting = False
+        if self.events:
+            events, self.events = self.events, []
+            self.play_counts.clear()
+            sound_engine.play_batch(events)
+
+
+sound_events = SoundEvents()
+
+
+def begin_sound_batch() -> None:
+    # from now on sound requests are collected, instead of played immediately
+    sound_events.begin()
+
+
+def end_sound_batch() -> None:
+    # plays the collected sound requests
+    sound_events.end()
+
+
 def play_sample(samplename, repeat=False, after=0.0):
+    if sound_events.collecting:
+        sound_events.play(samplename, repeat, after)
+        return None
     return sound_engine.play_sample(samplename, repeat, after)
 
 
 def silence_audio(sid_or_name=None):
-    sound_engine.silence(sid_or_name)
+    if sound_events.collecting and not isinstance(sid_or_name, int):
+        sound_events.silence(sid_or_name)
+    else:
+        sound_engine.silence(sid_or_name)
 
 
 def shutdown_audio():
     sound_engine.close()
 
 
-def check_api():
-    a = best_api()
-    a.close()
+def mixer_stats() -> Tuple[int, float]:
+    # number of voices in the last mixed chunk, and the time it took to mix it (in seconds)
+    if not isinstance(sound_engine, SoundEngine) or not sound_engine.output.audio_api:
+        return 0, 0.0
+    mixer = sound_engine.output.audio_api.mixer
+    return mixer.last_mix_voices, mixer.last_mix_duration
+
+
+def check_api() -> Dict[str, Any]:
+    # Determines the audio output api to use. The result of this probe is remembered
+    # (in the user data dir), so on later runs no audio device has to be opened just to check this.
+    # The output device isn't remembered: device numbers change when devices are plugged in or out,
+    # and the api picks the device itself when it is opened.
+    probe = load_probe()
+    if not probe:
+        api = best_api()
+        try:
+            probe = {
+                "fingerprint": probe_fingerprint(),
+                "api": type(api).__name__,
+                "api_version": api.query_api_version()
+            }
+        finally:
+            api.close()
+        try:
+            with open(probe_cache_file, "wt") as out:
+                json.dump(probe, out, indent=2)
+        except OSError:
+            pass
+    playback.preferred_api = probe["api"]
+    return probe
 
 
 if __name__ == "__main__":
@@ -0,0 +1,216 @@
+"""
+Boulder Caves - a Boulder Dash (tm) clone.
+
+Benchmark suite for the game logic, the tile sheet, sprite loading,
+cave decoding and the audio mixer and synthesizer.
+Everything runs headless with fixed random seeds so results are reproducible.
+The results can be written as json, and compared against a previously stored
+baseline result to detect performance regressions.
+
+Usage:  python -m bouldercaves.bench [-o results.json] [--baseline baseline.json]
+
+Written by Irmen de Jong (irmen@razorvine.net)
+License: GNU GPL 3.0, see LICENSE
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import random
+import platform
+import statistics
+import functools
+from typing import Callable, Dict, List, Any, Tuple, Optional
+from .synthplayer import params as synth_params
+from .synthplayer.sample import Sample
+from .synthplayer.playback import RealTimeMixer
+from .headless import HeadlessGame
+from . import caves, bdcff, tiles, synthsamples
+
+
+caves_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "caves")
+logic_frames = 100
+mixer_chunks = 200
+mixer_voices = (1, 4, 8, 16)
+sprite_scales = (1, 1.5, 2, 2.5, 3)
+
+
+def measure(func: Callable[[], Any], repeat: int) -> Dict[str, Any]:
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return {
+        "best": min(durations),
+        "median": statistics.median(durations),
+        "runs": repeat
+    }
+
+
+def bench_logic(levelnumber: int) -> Callable[[], None]:
+    game = HeadlessGame()
+
+    def run() -> None:
+        random.seed(levelnumber)
+        game.start_level(levelnumber)
+        for _ in range(logic_frames):
+            game.update()
+    return run
+
+
+def bench_tilesheet_dirty() -> None:
+    rnd = random.Random(42)
+    sheet = tiles.Tilesheet(100, 100, 40, 22)
+    sheet.set_view(30, 40)
+    for _ in range(1000):
+        for _ in range(100):
+            sheet[rnd.randrange(100), rnd.randrange(100)] = rnd.randrange(400)
+        sheet.dirty()
+
+
+def bench_load_sprites(scale: float) -> Callable[[], None]:
+    def run() -> None:
+        tiles.load_sprites(scale=scale, use_cache=False)
+    return run
+
+
+def bench_cave_decode() -> None:
+    caveset = caves.CaveSet()
+    for levelnumber in range(1, caveset.num_caves + 1):
+        caveset.cave(levelnumber)
+
+
+def bench_bdcff_parse(filename: str) -> Callable[[], None]:
+    def run() -> None:
+        bdcff.BdcffParser(filename)
+    return run
+
+
+def bench_mixer(voices: int) -> Callable[[], None]:
+    chunksize = synth_params.norm_frames_per_chunk * synth_params.norm_samplewidth * synth_params.norm_nchannels
+    rnd = random.Random(42)
+    frames = bytes(rnd.getrandbits(8) for _ in range(chunksize * mixer_chunks))
+    samples = [Sample.from_raw_frames(frames, synth_params.norm_samplewidth, synth_params.norm_samplerate,
+                                      synth_params.norm_nchannels, name="voice{:d}".format(v)) for v in range(voices)]
+
+    def run() -> None:
+        mixer = RealTimeMixer(chunksize, pop_prevention=False)
+        for sample in samples:
+            mixer.add_sample(sample)
+        chunks = mixer.chunks()
+        for _ in range(mixer_chunks):
+            next(chunks)
+        mixer.close()
+    return run
+
+
+def bench_mixer_starts() -> Callable[[], None]:
+    # a short sound started (and another one stopped) every chunk, with the anti-pop fades
+    chunksize = synth_params.norm_frames_per_chunk * synth_params.norm_samplewidth * synth_params.norm_nchannels
+    rnd = random.Random(42)
+    sample = Sample.from_raw_frames(bytes(rnd.getrandbits(8) for _ in range(chunksize * 4)), synth_params.norm_samplewidth,
+                                    synth_params.norm_samplerate, synth_params.norm_nchannels, name="walk")
+
+    def run() -> None:
+        mixer = RealTimeMixer(chunksize, pop_prevention=True)
+        chunks = mixer.chunks()
+        for chunk in range(mixer_chunks):
+            sid = mixer.add_sample(sample)
+            next(chunks)
+            if chunk % 2:
+                mixer.clear_source(sid)     # type: ignore
+        mixer.close()
+    return run
+
+
+def bench_synth() -> None:
+    random.seed(42)
+    for synth in (synthsamples.ExtraLife, synthsamples.WalkDirt, synthsamples.WalkEmpty, synthsamples.Explosion,
+                  synthsamples.VoodooExplosion, synthsamples.CollectDiamond, synthsamples.Boulder,
+                  synthsamples.Crack, synthsamples.BoxPush, synthsamples.Slime):
+        synth()
+    for timeout in range(1, 10):
+        synthsamples.Timeout(timeout)
+
+
+def benchmarks() -> List[Tuple[str, Callable[[], Callable[[], Any]]]]:
+    # (name, setup function that returns the function to be measured)
+    benches = []    # type: List[Tuple[str, Callable[[], Callable[[], Any]]]]
+    for levelnumber in range(1, len(caves.BD1CAVES) + 1):
+        benches.append(("logic.cave{:02d}".format(levelnumber), functools.partial(bench_logic, levelnumber)))
+    benches.append(("tilesheet.dirty", lambda: bench_tilesheet_dirty))
+    for scale in sprite_scales:
+        benches.append(("tiles.load_sprites.x{:g}".format(scale), functools.partial(bench_load_sprites, scale)))
+    benches.append(("caves.decode", lambda: bench_cave_decode))
+    for filename in sorted(glob.glob(os.path.join(caves_dir, "*.bd"))):
+        name = os.path.splitext(os.path.basename(filename))[0]
+        benches.append(("bdcff.parse." + name, functools.partial(bench_bdcff_parse, filename)))
+    for voices in mixer_voices:
+        benches.append(("mixer.voices{:d}".format(voices), functools.partial(bench_mixer, voices)))
+    benches.append(("mixer.starts", bench_mixer_starts))
+    benches.append(("synth.prerender", lambda: bench_synth))
+    return benches
+
+
+def run_benchmarks(repeat: int, selection: List[str]) -> Dict[str, Any]:
+    results = {}    # type: Dict[str, Dict[str, Any]]
+    for name, setup in benchmarks():
+        if selection and not any(name.startswith(s) for s in selection):
+            continue
+        result = measure(setup(), repeat)
+        print("{:32s} {:10.2f} ms  (best {:.2f} ms)".format(name, result["median"] * 1000, result["best"] * 1000))
+        results[name] = result
+    return {
+        "python": platform.python_implementation() + " " + platform.python_version(),
+        "platform": platform.platform(),
+        "pillow": tiles.pillow_version,
+        "results": results
+    }
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    """Prints the comparison against the baseline and returns the names of the benchmarks that regressed."""
+    regressions = []
+    print("\nCompared to baseline (regression threshold {:.0f}%):".format(threshold * 100))
+    for name, result in results["results"].items():
+        base = baseline["results"].get(name)
+        if not base:
+            print("{:32s}  (not in baseline)".format(name))
+            continue
+        ratio = result["median"] / base["median"]
+        verdict = ""
+        if ratio > 1 + threshold:
+            verdict = "REGRESSION"
+            regressions.append(name)
+        elif ratio < 1 - threshold:
+            verdict = "faster"
+        print("{:32s} {:+7.1f}%  {:s}".format(name, (ratio - 1) * 100, verdict))
+    return regressions
+
+
+def main(args: Optional[List[str]]=None) -> None:
+    import argparse
+    ap = argparse.ArgumentParser(description="Boulder Caves benchmarks")
+    ap.add_argument("-o", "--output", metavar="FILE", help="write the results to this json file")
+    ap.add_argument("-b", "--baseline", metavar="FILE", help="compare the results against this baseline json file")
+    ap.add_argument("-t", "--threshold", type=float, default=0.10,
+                    help="relative slowdown that counts as a regression (default=%(default).2f)")
+    ap.add_argument("-r", "--repeat", type=int, default=5, help="number of runs per benchmark (default=%(default)d)")
+    ap.add_argument("benchmarks", nargs="*", help="only run benchmarks whose name starts with one of these")
+    parsed = ap.parse_args(args)
+    results = run_benchmarks(parsed.repeat, parsed.benchmarks)
+    if parsed.output:
+        with open(parsed.output, "wt") as out:
+            json.dump(results, out, indent=2)
+    if parsed.baseline:
+        with open(parsed.baseline, "rt") as f:
+            baseline = json.load(f)
+        if compare(results, baseline, parsed.threshold):
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
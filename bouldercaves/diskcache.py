@@ -0,0 +1,127 @@
+"""
+Boulder Caves - a Boulder Dash (tm) clone.
+
+Content-addressed on-disk cache for processed assets,
+stored in the user data directory. A cache entry is a list of binary blobs.
+Entries are never updated, only added; the oldest entries of a kind are pruned.
+
+Written by Irmen de Jong (irmen@razorvine.net)
+License: GNU GPL 3.0, see LICENSE
+"""
+
+import os
+import glob
+import mmap
+import struct
+import hashlib
+from typing import Any, Callable, List, Optional, Sequence, Union
+from . import user_data_dir
+
+
+cache_dir = os.path.join(user_data_dir, "cache")
+max_entries_per_kind = 40
+_magic = b"BCCACHE1"
+
+
+def make_key(*parts: Any) -> str:
+    """Makes a cache key out of the given parts. Bytes are hashed by content, other parts by their repr."""
+    digest = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, (bytes, bytearray, memoryview)):
+            digest.update(hashlib.sha1(part).digest())
+        else:
+            digest.update(repr(part).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def _entry_path(kind: str, key: str) -> str:
+    return os.path.join(cache_dir, "{:s}-{:s}.bin".format(kind, key))
+
+
+def load(kind: str, key: str) -> Optional[List[bytes]]:
+    """Returns the cached blobs, or None if the entry is not in the cache (or is unreadable)."""
+    path = _entry_path(kind, key)
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        os.utime(path)    # keeps recently used entries from being pruned
+    except OSError:
+        return None
+    return _split_blobs(data)     # type: ignore
+
+
+def load_mapped(kind: str, key: str) -> Optional[List[memoryview]]:
+    """
+    Like load(), but the file is memory mapped instead of read, and the blobs are memoryviews on the mapping.
+    Nothing is copied, the data is paged in by the OS when it's used.
+    """
+    path = _entry_path(kind, key)
+    try:
+        with open(path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        os.utime(path)
+    except (OSError, ValueError):
+        return None
+    return _split_blobs(memoryview(mapped))   # type: ignore
+
+
+def _split_blobs(data: Union[bytes, memoryview]) -> Optional[List[Union[bytes, memoryview]]]:
+    if bytes(data[:len(_magic)]) != _magic:
+        return None
+    try:
+        count, = struct.unpack_from("<I", data, len(_magic))
+        offset = len(_magic) + 4
+        lengths = struct.unpack_from("<{:d}I".format(count), data, offset)
+        offset += 4 * count
+        if offset + sum(lengths) != len(data):
+            return None
+        blobs = []
+        for length in lengths:
+            blobs.append(data[offset: offset + length])
+            offset += length
+        return blobs
+    except struct.error:
+        return None
+
+
+def store(kind: str, key: str, blobs: Sequence[Union[bytes, memoryview]]) -> None:
+    """Stores the blobs in the cache. Failure to write the cache is not an error."""
+    path = _entry_path(kind, key)
+    tmp_path = "{:s}.{:d}.tmp".format(path, os.getpid())
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(tmp_path, "wb") as out:
+            out.write(_magic)
+            out.write(struct.pack("<I", len(blobs)))
+            out.write(struct.pack("<{:d}I".format(len(blobs)), *[len(blob) for blob in blobs]))
+            for blob in blobs:
+                out.write(blob)
+        os.replace(tmp_path, path)
+        _prune(kind)
+    except OSError as x:
+        print("can't write asset cache:", x)
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+
+def cached(kind: str, key: str, producer: Callable[[], Sequence[bytes]]) -> Sequence[bytes]:
+    """Returns the cached blobs, or calls the producer to create (and cache) them."""
+    blobs = load(kind, key)
+    if blobs is None:
+        blobs = list(producer())
+        store(kind, key, blobs)
+    return blobs
+
+
+def _prune(kind: str) -> None:
+    entries = glob.glob(_entry_path(kind, "*"))
+    if len(entries) > max_entries_per_kind:
+        entries.sort(key=os.path.getmtime)
+        for path in entries[:len(entries) - max_entries_per_kind]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,113 @@
+"""
+Boulder Caves - a Boulder Dash (tm) clone.
+
+Frame scheduling and frame time statistics.
+
+Written by Irmen de Jong (irmen@razorvine.net)
+License: GNU GPL 3.0, see LICENSE
+"""
+
+import array
+import json
+from typing import Dict, List, Any
+
+
+class Histogram:
+    """
+    Histogram of durations with fixed size buckets, so recording a duration is cheap
+    and percentiles can be calculated at any time without keeping all samples.
+    """
+    bucket_size = 0.1   # milliseconds
+    max_duration = 250  # milliseconds, longer durations end up in the last bucket
+
+    def __init__(self) -> None:
+        self.buckets = array.array('L', [0] * int(self.max_duration / self.bucket_size + 1))
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def add(self, seconds: float) -> None:
+        millis = self.last = seconds * 1000.0
+        self.buckets[min(int(millis / self.bucket_size), len(self.buckets) - 1)] += 1
+        self.count += 1
+        self.total += millis
+        if millis > self.max:
+            self.max = millis
+
+    def percentile(self, percentage: float) -> float:
+        """Returns the duration in milliseconds below which the given percentage of the durations fall."""
+        if not self.count:
+            return 0.0
+        threshold = self.count * percentage / 100.0
+        seen = 0
+        for bucket, amount in enumerate(self.buckets):
+            seen += amount
+            if seen >= threshold:
+                return (bucket + 1) * self.bucket_size
+        return self.max_duration
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "mean": round(self.total / self.count, 3) if self.count else 0.0,
+            "p50": round(self.percentile(50), 3),
+            "p95": round(self.percentile(95), 3),
+            "p99": round(self.percentile(99), 3),
+            "max": round(self.max, 3)
+        }
+
+
+class FrameStats:
+    """Frame time histograms for the game logic, the repaints and the total time spent per tick."""
+    def __init__(self) -> None:
+        self.logic = Histogram()
+        self.repaint = Histogram()
+        self.total = Histogram()
+        self.lateness = Histogram()
+        self.dropped_logic_frames = 0
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "logic_ms": self.logic.summary(),
+            "repaint_ms": self.repaint.summary(),
+            "total_ms": self.total.summary(),
+            "tick_lateness_ms": self.lateness.summary(),
+            "dropped_logic_frames": self.dropped_logic_frames
+        }
+
+    def report_lines(self) -> List[str]:
+        lines = ["frame times   p50    p95    p99    max"]
+        for name, histogram in [("logic", self.logic), ("repaint", self.repaint), ("total", self.total), ("late", self.lateness)]:
+            lines.append("{:8s} {:7.1f}{:7.1f}{:7.1f}{:7.1f}".format(name, histogram.percentile(50), histogram.percentile(95),
+                                                                     histogram.percentile(99), histogram.max))
+        lines.append("dropped logic frames: {:d}".format(self.dropped_logic_frames))
+        return lines
+
+    def dump_json(self, filename: str) -> None:
+        with open(filename, "wt") as out:
+            json.dump(self.summary(), out, indent=2)
+
+
+class FrameScheduler:
+    """
+    Schedules ticks at a fixed period. It measures how late each tick actually started
+    and shortens the next delay accordingly, instead of always waiting for a fixed delay.
+    If it's more than a full period behind, it doesn't try to catch up but starts afresh.
+    """
+    def __init__(self, period: float) -> None:
+        self.period = period
+        self.next_tick = 0.0
+
+    def start(self, now: float) -> None:
+        self.next_tick = now
+
+    def lateness(self, now: float) -> float:
+        return max(0.0, now - self.next_tick)
+
+    def next_delay(self, now: float) -> int:
+        """Returns the delay in milliseconds until the next tick should start."""
+        self.next_tick += self.period
+        if now - self.next_tick > self.period:
+            self.next_tick = now + self.period
+        return max(0, int(round((self.next_tick - now) * 1000.0)))
@@ -17,24 +17,211 @@ import tkinter.messagebox
 from tkinter import simpledialog
 import pkgutil
 import time
-from typing import Tuple, Sequence, List, Iterable, Callable, Optional
+import queue
+import functools
+import threading
+import traceback
+from typing import Tuple, Sequence, List, Iterable, Callable, Optional, Dict
 from .gamelogic import GameState, Direction, GameStatus, HighScores
 from .caves import colorpalette, Palette
-from . import audio, synthsamples, tiles, objects, bdcff
+from . import audio, tiles, objects, bdcff, framestats, tracing, startup, warmup
 from .synthplayer import sample
 
 __version__ = "5.4"
 
 
+def in_gui_thread(method: Callable) -> Callable:
+    """
+    Decorator for window methods that use tkinter. When such a method is called
+    from the game logic thread, the call is executed on the gui thread instead,
+    and the logic thread waits for its result.
+    """
+    @functools.wraps(method)
+    def wrapper(window: 'BoulderWindow', *args, **kwargs):
+        if window.logic_thread and threading.current_thread() is window.logic_thread:
+            return window.logic_thread.call_in_gui_thread(method, window, *args, **kwargs)
+        return method(window, *args, **kwargs)
+    return wrapper
+
+
+def in_logic_thread(method: Callable) -> Callable:
+    """
+    Decorator for window methods that change the game state (such as the keyboard handlers).
+    When the game logic runs in its own thread, the call is queued and executed by that thread instead.
+    """
+    @functools.wraps(method)
+    def wrapper(window: 'BoulderWindow', *args, **kwargs) -> None:
+        if window.logic_thread and threading.current_thread() is not window.logic_thread:
+            window.logic_thread.logic_calls.put((method, (window,) + args, kwargs))
+        else:
+            method(window, *args, **kwargs)
+    return wrapper
+
+
+class GameLogicThread(threading.Thread):
+    """
+    Runs the game logic updates in a separate thread, at the game logic's own pace.
+    Everything that touches the game state (and the tilesheet) is done while holding the logic_lock;
+    the gui thread only tries to take the lock to prepare a new frame and never waits for it.
+    """
+    def __init__(self, window: 'BoulderWindow') -> None:
+        super().__init__(name="gamelogic", daemon=True)
+        self.window = window
+        self.logic_lock = threading.Lock()
+        self.logic_calls = queue.Queue()    # type: queue.Queue
+        self.gui_calls = queue.Queue()      # type: queue.Queue
+        self.stopped = False
+        self.error = None   # type: Optional[BaseException]
+
+    def run(self) -> None:
+        try:
+            timestep = self.window.gamestate.update_timestep
+            next_update = time.perf_counter() + timestep
+            while not self.stopped:
+                try:
+                    method, args, kwargs = self.logic_calls.get(timeout=max(0.0, next_update - time.perf_counter()))
+                    with self.logic_lock:
+                        method(*args, **kwargs)
+                    continue
+                except queue.Empty:
+                    pass
+                with self.logic_lock:
+                    start = time.perf_counter()
+                    self.window.update_game()
+                    self.window.frame_stats.logic.add(time.perf_counter() - start)
+                next_update += timestep
+                now = time.perf_counter()
+                if now - next_update > timestep * self.window.max_logic_catchup:
+                    # way behind, don't try to catch up all those frames
+                    self.window.frame_stats.dropped_logic_frames += int((now - next_update) / timestep)
+                    next_update = now
+        except BaseException as x:
+            if not self.stopped:
+                self.error = x
+                if not isinstance(x, SystemExit):
+                    traceback.print_exc()
+
+    def stop(self) -> None:
+        self.stopped = True
+
+    def call_in_gui_thread(self, method: Callable, *args, **kwargs):
+        done = threading.Event()
+        result = [None, None]     # type: List
+        self.gui_calls.put((method, args, kwargs, done, result))
+        while not done.wait(0.1):
+            if self.stopped:
+                raise SystemExit
+        if result[1]:
+            raise result[1]
+        return result[0]
+
+    def run_gui_calls(self) -> None:
+        # executes the pending tkinter calls of the logic thread (must be called from the gui thread)
+        while not self.gui_calls.empty():
+            method, args, kwargs, done, result = self.gui_calls.get()
+            try:
+                result[0] = method(*args, **kwargs)
+            except BaseException as x:
+                result[1] = x
+            done.set()
+
+
+class TileImages:
+    """
+    The images of all tiles (sprites followed by the font glyphs), indexed by tile number.
+    A tile image is sliced out of the atlas image the first time it is used,
+    because most caves only use a small fraction of all tiles. That is only a single
+    Tk photo image region copy, so it doesn't cause a noticeable delay.
+    Optionally, the remaining tiles can be created in the background when the gui is idle.
+    Dynamic tiles can be added after the regular ones; their image shows a copy of another tile
+    that can be changed, which updates every canvas item that uses the dynamic tile at once.
+    """
+    def __init__(self, tkroot: tkinter.Tk, sprite_atlas: tkinter.PhotoImage, sprite_size: int,
+                 font_atlas: tkinter.PhotoImage, glyph_size: int) -> None:
+        self.tkroot = tkroot
+        self.sprite_atlas = sprite_atlas
+        self.sprite_size = sprite_size
+        self.font_atlas = font_atlas
+        self.glyph_size = glyph_size
+        self.images = [None] * (tiles.num_sprites + 128)  # type: List[Optional[tkinter.PhotoImage]]
+        self.dynamic_sources = {}   # type: Dict[int, int]
+
+    def __len__(self) -> int:
+        return len(self.images)
+
+    def __getitem__(self, tile: int) -> tkinter.PhotoImage:
+        image = self.images[tile]
+        if image is None:
+            size = self.sprite_size if tile < tiles.num_sprites else self.glyph_size
+            image = self.images[tile] = tkinter.PhotoImage(width=size, height=size)
+            self.copy_tile(tile, image)
+        return image
+
+    def copy_tile(self, tile: int, image: tkinter.PhotoImage) -> None:
+        # copy the tile's region from the atlas image into the given image
+        if tile < tiles.num_sprites:
+            x1, y1, x2, y2 = tiles.atlas_tile_box(tile, self.sprite_size, 8)
+            atlas = self.sprite_atlas
+        else:
+            x1, y1, x2, y2 = tiles.atlas_tile_box(tile - tiles.num_sprites, self.glyph_size, 32)
+            atlas = self.font_atlas
+        image.tk.call(image, "copy", atlas, "-from", x1, y1, x2, y2, "-to", 0, 0)
+
+    def refresh(self) -> None:
+        # copy the tiles that have been created again, after the atlas image has changed
+        for tile, image in enumerate(self.images):
+            if image:
+                self.copy_tile(self.dynamic_sources.get(tile, tile), image)
+
+    def add_dynamic_tile(self, source_tile: int) -> int:
+        tile = len(self.images)
+        self.images.append(tkinter.PhotoImage(width=self.sprite_size, height=self.sprite_size))
+        self.dynamic_sources[tile] = -1
+        self.set_dynamic_tile(tile, source_tile)
+        return tile
+
+    def set_dynamic_tile(self, tile: int, source_tile: int) -> None:
+        if self.dynamic_sources[tile] != source_tile:
+            self.copy_tile(source_tile, self[tile])
+            self.dynamic_sources[tile] = source_tile
+
+    def warm_up(self, batch_size: int=8) -> None:
+        # create the remaining tile images in small batches whenever the gui is idle
+        missing = [tile for tile, image in enumerate(self.images) if image is None]
+
+        def create_batch() -> None:
+            for tile in missing[:batch_size]:
+                self[tile]      # creates the image
+            del missing[:batch_size]
+            if missing:
+                self.tkroot.after_idle(create_batch)
+
+        if missing:
+            self.tkroot.after_idle(create_batch)
+
+
+# looping animations that can be shown with the same animation phase in all cells
+shared_animation_objects = (
+    objects.AMOEBA, objects.AMOEBARECTANGLE, objects.MAGICWALL, objects.SLIME, objects.DIAMOND, objects.FLYINGDIAMOND,
+    objects.FIREFLY, objects.ALTFIREFLY, objects.BUTTERFLY, objects.ALTBUTTERFLY, objects.INBOXBLINKING, objects.OUTBOXBLINKING,
+    objects.WATER, objects.LAVA, objects.BONUSBG, objects.REPLICATOR, objects.CONVEYORLEFT, objects.CONVEYORRIGHT
+)
+
+
 class BoulderWindow(tkinter.Tk):
     update_fps = 30
     update_timestep = 1 / update_fps
     visible_columns = 40
     visible_rows = 22
     scalexy = 2.0
+    tick_period = 1 / 60
+    max_logic_catchup = 5   # max number of logic updates in a single tick to catch up, to avoid a spiral of death
 
     def __init__(self, title: str, fps: int=30, scale: float=2,
-                 c64colors: bool=False, c64_alternate_tiles: bool=False, smallwindow: bool=False) -> None:
+                 c64colors: bool=False, c64_alternate_tiles: bool=False, smallwindow: bool=False,
+                 warm_up_tiles: bool=False, shared_animations: bool=False, threaded_logic: bool=False,
+                 frame_stats_file: str="", tile_atlases: Tuple[bytes, bytes]=None,
+                 wait_for_tiles: Optional[Callable[[tkinter.Tk], Tuple[bytes, bytes]]]=None) -> None:
         scale = scale / 2
         self.smallwindow = smallwindow
         if smallwindow:
@@ -81,16 +268,44 @@ class BoulderWindow(tkinter.Tk):
                                      height=self.visible_rows * 16 * self.scalexy,
                                      borderwidth=0, highlightthickness=0, background="black",
                                      xscrollincrement=self.scalexy, yscrollincrement=self.scalexy)
+        self.logic_thread = GameLogicThread(self) if threaded_logic else None
+        self.scheduler = framestats.FrameScheduler(self.tick_period)
+        self.frame_stats = framestats.FrameStats()
+        self.frame_stats_file = frame_stats_file
+        self.overlay = tkinter.Label(self, font="TkFixedFont", justify=tkinter.LEFT, anchor=tkinter.NW,
+                                     foreground="white", background="black")
+        self.overlay_shown = ""     # "frametimes" or "counters" when the debug overlay is shown
+        self.last_tcl_calls = 0
         self.c_tiles = []         # type: List[str]
         self.cscore_tiles = []    # type: List[str]
         self.view_x = 0
         self.view_y = 0
         self.canvas.view_x = self.view_x        # type: ignore
         self.canvas.view_y = self.view_y        # type: ignore
-        self.tile_images = []  # type: List[tkinter.PhotoImage]
+        self.indexed_sprite_atlas = b""
+        self.cover_tile = 0
+        self.tiles_revealed = bytearray()
+        self.shared_animation_tiles = {}   # type: Dict[objects.GameObject, int]
+        self.magicwall_shown_active = False
+        self.tile_images_palette = ()   # type: Tuple[int, ...]
         self.playfield_columns = 0
         self.playfield_rows = 0
-        self.create_tile_images()
+        startup.profiler.mark("window creation")
+        if wait_for_tiles:
+            # the window stays hidden while the tile atlases are being prepared (a splash window can show the progress)
+            self.withdraw()
+            tile_atlases = wait_for_tiles(self)
+            self.deiconify()
+        self.create_tile_images(tile_atlases)
+        startup.profiler.mark("sprite loading")
+        if warm_up_tiles:
+            self.tile_images.warm_up()
+        # the cover animation of the reveal, and optionally all animations that can share their phase,
+        # are done by changing the image of a single dynamic tile instead of changing every cell that shows it.
+        self.cover_tile = self.tile_images.add_dynamic_tile(objects.COVERED.tile())
+        if shared_animations:
+            for obj in shared_animation_objects:
+                self.shared_animation_tiles[obj] = self.tile_images.add_dynamic_tile(obj.tile())
         self.create_canvas_playfield_and_tilesheet(40, 22)
         self.bind("<KeyPress>", self.keypress)
         self.bind("<KeyRelease>", self.keyrelease)
@@ -104,9 +319,18 @@ class BoulderWindow(tkinter.Tk):
         self.popup_frame = 0
         self.last_demo_or_highscore_frame = 0
         self.gamestate = GameState(self)
+        startup.profiler.mark("window creation")
 
     def destroy(self) -> None:
+        if self.logic_thread:
+            self.logic_thread.stop()
+            if self.logic_thread.is_alive():
+                self.logic_thread.join(timeout=1)
+        if self.frame_stats_file:
+            self.frame_stats.dump_json(self.frame_stats_file)
+            print("Frame time statistics written to", self.frame_stats_file)
         audio.shutdown_audio()
+        tracing.stop()
         self.gamestate.destroy()
         super().destroy()
 
@@ -122,26 +346,97 @@ class BoulderWindow(tkinter.Tk):
             else:
                 fmt = "Playing caveset:\n\n\x0f\x0f`{name}'\n\n\x0f\x0fby {author}\n\n\x0f\x0f\x0f\x0f({date})"
             self.popup(fmt.format(name=cs.name, author=cs.author, date=cs.date), duration=3)
+        if self.logic_thread:
+            self.logic_thread.start()
+        self.scheduler.start(self.gfxupdate_starttime)
         self.tick_loop()
 
     def tick_loop(self) -> None:
-        now = time.perf_counter()
+        now = tick_start = time.perf_counter()
+        self.frame_stats.lateness.add(self.scheduler.lateness(now))
         dt = now - self.gfxupdate_starttime
-        self.game_update_dt += dt
-        while self.game_update_dt > self.gamestate.update_timestep:
-            self.game_update_dt -= self.gamestate.update_timestep
-            self.update_game()
+        if self.logic_thread:
+            if self.logic_thread.error:
+                # an exception raised in an 'after' callback would only be printed by Tk and
+                # leave a frozen window, so close the window and leave the mainloop instead
+                error = self.logic_thread.error
+                self.destroy()
+                if isinstance(error, SystemExit):
+                    raise error
+                raise SystemExit("Game logic thread crashed: {}".format(error))
+            self.logic_thread.run_gui_calls()
+        else:
+            self.game_update_dt += dt
+            logic_updates = 0
+            while self.game_update_dt > self.gamestate.update_timestep:
+                if logic_updates >= self.max_logic_catchup:
+                    # too far behind, skip the remaining updates instead of spiraling into ever longer ticks
+                    self.frame_stats.dropped_logic_frames += int(self.game_update_dt / self.gamestate.update_timestep)
+                    self.game_update_dt %= self.gamestate.update_timestep
+                    break
+                self.game_update_dt -= self.gamestate.update_timestep
+                self.update_game()
+                logic_updates += 1
+                logic_done = time.perf_counter()
+                self.frame_stats.logic.add(logic_done - now)
+                now = logic_done
         self.graphics_update_dt += dt
-        if self.gamestate.game_status in (GameStatus.REVEALING_DEMO, GameStatus.REVEALING_PLAY) and not self.popup_tiles_save:
-            self.do_reveal()
-        if self.graphics_update_dt > self.update_timestep:
-            self.graphics_update_dt -= self.update_timestep
-            if self.graphics_update_dt >= self.update_timestep:
-                print("Gfx update too slow to reach {:d} fps!".format(self.update_fps))
-            self.repaint()
-        self.gfxupdate_starttime = now
-        self.after(1000 // 60, self.tick_loop)
+        frame = None
+        if self.logic_thread and not self.logic_thread.logic_lock.acquire(blocking=False):
+            pass    # the logic thread is busy, try again next tick rather than waiting for it
+        else:
+            try:
+                if self.gamestate.game_status in (GameStatus.REVEALING_DEMO, GameStatus.REVEALING_PLAY) and not self.popup_tiles_save:
+                    self.do_reveal()
+                if self.graphics_update_dt > self.update_timestep:
+                    self.graphics_update_dt -= self.update_timestep
+                    if self.graphics_update_dt >= self.update_timestep:
+                        print("Gfx update too slow to reach {:d} fps!".format(self.update_fps))
+                    repaint_start = time.perf_counter()
+                    frame = self.prepare_frame()
+            finally:
+                if self.logic_thread:
+                    self.logic_thread.logic_lock.release()
+        if frame:
+            self.present_frame(*frame)
+            self.frame_stats.repaint.add(time.perf_counter() - repaint_start)
+            if not startup.profiler.first_frame_shown:
+                self.update_idletasks()     # make sure the first frame is actually drawn
+                startup.profiler.first_frame()
+            if self.overlay_shown and self.graphics_frame % (self.update_fps // 2 or 1) == 0:
+                self.overlay.configure(text="\n".join(self.overlay_lines()))
+        end = time.perf_counter()
+        self.frame_stats.total.add(end - tick_start)
+        self.gfxupdate_starttime = tick_start
+        self.after(self.scheduler.next_delay(end), self.tick_loop)
 
+    @in_gui_thread
+    def toggle_overlay(self, kind: str) -> None:
+        self.overlay_shown = "" if self.overlay_shown == kind else kind
+        self.gamestate.count_get_calls(self.overlay_shown == "counters")
+        if self.overlay_shown:
+            self.overlay.configure(text="\n".join(self.overlay_lines()))
+            self.overlay.place(in_=self.canvas, x=4, y=4)
+        else:
+            self.overlay.place_forget()
+
+    def overlay_lines(self) -> List[str]:
+        if self.overlay_shown == "counters":
+            voices, mix_duration = audio.mixer_stats()
+            return [
+                "logic ms    {:7.2f}".format(self.frame_stats.logic.last),
+                "repaint ms  {:7.2f}".format(self.frame_stats.repaint.last),
+                "dirty tiles {:4d}".format(self.tilesheet.last_dirty_count),
+                "tcl calls   {:4d}".format(self.last_tcl_calls),
+                "active cells{:5d}".format(self.gamestate.active_cells),
+                "get() calls {:5d}".format(self.gamestate.last_get_calls),
+                "voices      {:4d}".format(voices),
+                "mix ms      {:7.2f}".format(mix_duration * 1000.0),
+                "sounds coll.{:5d}".format(audio.sound_events.collapsed)
+            ]
+        return self.frame_stats.report_lines()
+
+    @in_logic_thread
     def keypress(self, event) -> None:
         if event.keysym.startswith("Shift") or event.state & 1:
             self.gamestate.movement.start_grab()
@@ -192,6 +487,7 @@ class BoulderWindow(tkinter.Tk):
         self.scrollxypixels(0, 0)
         self.gamestate.restart()
 
+    @in_logic_thread
     def keyrelease(self, event) -> None:
         if event.keysym.startswith("Shift") or not (event.state & 1):
             self.gamestate.movement.stop_grab()
@@ -212,11 +508,14 @@ class BoulderWindow(tkinter.Tk):
             print("random colors:", colors)
             self.create_colored_tiles(colors)
             self.set_screen_colors(colors.rgb_screen, colors.rgb_border)
-            self.tilesheet.all_dirty()
         elif event.keysym == "F4":
             self.gamestate.show_highscores()
         elif event.keysym == "F9":
             self.gamestate.start_demo()
+        elif event.keysym == "F10":
+            self.toggle_overlay("frametimes")
+        elif event.keysym == "F11":
+            self.toggle_overlay("counters")
         elif event.keysym == "F12":
             # launch the editor in a separate process
             import subprocess
@@ -225,7 +524,12 @@ class BoulderWindow(tkinter.Tk):
             env["PYTHONPATH"] = sys.path[0]
             subprocess.Popen([sys.executable, "-m", editor.__name__], env=env)
 
-    def repaint(self) -> None:
+    @tracing.traced("prepare_frame")
+    def prepare_frame(self) -> Tuple[Sequence[Tuple[int, int]], Sequence[Tuple[int, int]], Optional[str]]:
+        # Updates the tilesheet for the next graphics frame, and returns the changes to be presented
+        # as (score tile changes, tile changes, background color). This reads the game state but doesn't touch tkinter
+        # (the shared animation tiles are copied in present_frame), so when the game logic runs in its own thread,
+        # only this part has to hold the logic lock.
         self.graphics_frame += 1
         self.scroll_focuscell_into_view()
         if self.smallwindow and self.gamestate.game_status == GameStatus.WAITING and self.popup_frame < self.graphics_frame:
@@ -234,28 +538,16 @@ class BoulderWindow(tkinter.Tk):
             x = (1 + math.sin(1.5 * math.pi + self.graphics_frame / self.update_fps)) * wavew / 2
             y = (1 + math.cos(math.pi + self.graphics_frame / self.update_fps / 1.4)) * waveh / 2
             self.scrollxypixels(x, y)
-        for index, tile in self.tilesheet_score.dirty():
-            self.scorecanvas.itemconfigure(self.cscore_tiles[index], image=self.tile_images[tile])
-        # smooth scroll
-        if self.canvas.view_x != self.view_x:       # type: ignore
-            self.canvas.xview_moveto(0)
-            self.canvas.xview_scroll(self.view_x, tkinter.UNITS)
-            self.canvas.view_x = self.view_x        # type: ignore
-        if self.canvas.view_y != self.view_y:       # type: ignore
-            self.canvas.yview_moveto(0)
-            self.canvas.yview_scroll(self.view_y, tkinter.UNITS)
-            self.canvas.view_y = self.view_y        # type: ignore
+        score_changes = self.tilesheet_score.dirty()
         self.tilesheet.set_view(self.view_x // 16, self.view_y // 16)
 
         if self.popup_frame > self.graphics_frame:
-            for index, tile in self.tilesheet.dirty():
-                self.canvas.itemconfigure(self.c_tiles[index], image=self.tile_images[tile])
-            return
+            return score_changes, self.tilesheet.dirty(), None
         elif self.popup_tiles_save:
             self.popup_close()
 
         if self.gamestate.game_status in (GameStatus.REVEALING_PLAY, GameStatus.REVEALING_DEMO):
-            return
+            return score_changes, [], None
 
         if self.gamestate.rockford_cell:
             # is rockford moving or pushing left/right?
@@ -287,39 +579,74 @@ class BoulderWindow(tkinter.Tk):
                                 (self.graphics_frame - self.gamestate.rockford_cell.anim_start_gfx_frame)) % rockford_sprite.sframes
             self.tilesheet[self.gamestate.rockford_cell.x, self.gamestate.rockford_cell.y] = rockford_sprite.tile(animframe)
         # other animations:
-        for cell in self.gamestate.cells_with_animations():
-            obj = cell.obj
-            if obj is objects.MAGICWALL:
-                if not self.gamestate.magicwall["active"]:
-                    obj = objects.BRICK
-            animframe = int(obj.sfps / self.update_fps * (self.graphics_frame - cell.anim_start_gfx_frame))
-            self.tilesheet[cell.x, cell.y] = obj.tile(animframe)
-            if animframe >= obj.sframes and obj.anim_end_callback:
-                # the animation reached the last frame
-                obj.anim_end_callback(cell)
+        if self.shared_animation_tiles:
+            self.update_magicwall_tiles()
+        self.gamestate.update_animations(self.tilesheet, self.graphics_frame, self.update_fps, self.shared_animation_tiles)
         # flash
+        background = None
         if self.gamestate.flash > self.gamestate.frame:
-            self.configure(background=self.tkcolor(15) if self.graphics_frame % 2 else self.tkcolor(0))
+            background = self.tkcolor(15) if self.graphics_frame % 2 else self.tkcolor(0)
         elif self.gamestate.flash > 0:
-            self.configure(background="black")
-        for index, tile in self.tilesheet.dirty():
+            background = "black"
+        return score_changes, self.tilesheet.dirty(), background
+
+    @tracing.traced("present_frame")
+    def present_frame(self, score_changes: Sequence[Tuple[int, int]], changes: Sequence[Tuple[int, int]],
+                      background: Optional[str]) -> None:
+        if self.shared_animation_tiles:
+            self.update_shared_animations()
+        for index, tile in score_changes:
+            self.scorecanvas.itemconfigure(self.cscore_tiles[index], image=self.tile_images[tile])
+        # smooth scroll
+        scroll_calls = 0
+        if self.canvas.view_x != self.view_x:       # type: ignore
+            self.canvas.xview_moveto(0)
+            self.canvas.xview_scroll(self.view_x, tkinter.UNITS)
+            self.canvas.view_x = self.view_x        # type: ignore
+            scroll_calls += 2
+        if self.canvas.view_y != self.view_y:       # type: ignore
+            self.canvas.yview_moveto(0)
+            self.canvas.yview_scroll(self.view_y, tkinter.UNITS)
+            self.canvas.view_y = self.view_y        # type: ignore
+            scroll_calls += 2
+        for index, tile in changes:
             self.canvas.itemconfigure(self.c_tiles[index], image=self.tile_images[tile])
+        tcl_calls = len(score_changes) + len(changes) + scroll_calls
+        if background:
+            self.configure(background=background)
+            tcl_calls += 1
+        self.last_tcl_calls = tcl_calls
 
+    @in_gui_thread
+    @tracing.traced("create_colored_tiles")
     def create_colored_tiles(self, colors: Palette) -> None:
         if self.c64colors:
-            source_images = tiles.load_sprites(colors if self.c64colors else None, scale=self.scalexy,
-                                               alt_c64tileset=self.c64_alternate_tiles)
-            for i, image in enumerate(source_images):
-                self.tile_images[i] = tkinter.PhotoImage(data=image)
-
-    def create_tile_images(self) -> None:
-        initial_palette = Palette(2, 4, 13, 5, 6)
-        source_images = tiles.load_sprites(initial_palette if self.c64colors else None, scale=self.scalexy,
-                                           alt_c64tileset=self.c64_alternate_tiles)
-        self.tile_images = [tkinter.PhotoImage(data=image) for image in source_images]
-        source_images = tiles.load_font(self.scalexy if self.smallwindow else 2 * self.scalexy)
-        self.tile_images.extend([tkinter.PhotoImage(data=image) for image in source_images])
+            palette_rgbs = (colors.rgb_fg1, colors.rgb_fg2, colors.rgb_fg3, colors.rgb_amoeba, colors.rgb_slime, colors.rgb_screen)
+            if palette_rgbs == self.tile_images_palette:
+                return
+            # only the color table of the indexed sprite atlas is patched, and the existing tile images
+            # are updated in place (so the canvas picks up the new colors by itself, nothing needs to be marked dirty)
+            self.tile_images.sprite_atlas.configure(data=tiles.recolor_sprite_atlas(self.indexed_sprite_atlas, colors))
+            self.tile_images.refresh()
+            self.tile_images_palette = palette_rgbs
+
+    def create_tile_images(self, tile_atlases: Tuple[bytes, bytes]=None) -> None:
+        # the tile images are sliced out of a sprite atlas and a font atlas image, as soon as they're needed
+        sprite_atlas_data, font_atlas_data = tile_atlases or \
+            load_tile_atlases(self.c64colors, self.c64_alternate_tiles, self.scalexy, self.smallwindow)
+        if self.c64colors:
+            initial_palette = Palette(2, 4, 13, 5, 6)
+            self.indexed_sprite_atlas = sprite_atlas_data
+            sprite_atlas = tkinter.PhotoImage(data=tiles.recolor_sprite_atlas(self.indexed_sprite_atlas, initial_palette))
+            self.tile_images_palette = (initial_palette.rgb_fg1, initial_palette.rgb_fg2, initial_palette.rgb_fg3,
+                                        initial_palette.rgb_amoeba, initial_palette.rgb_slime, initial_palette.rgb_screen)
+        else:
+            sprite_atlas = tkinter.PhotoImage(data=sprite_atlas_data)
+        font_atlas = tkinter.PhotoImage(data=font_atlas_data)
+        self.tile_images = TileImages(self, sprite_atlas, int(16 * self.scalexy), font_atlas,
+                                      int(8 * font_scale(self.scalexy, self.smallwindow)))
 
+    @in_gui_thread
     def create_canvas_playfield_and_tilesheet(self, width: int, height: int) -> None:
         # create the images on the canvas for all tiles (fixed position):
         if width == self.playfield_columns and height == self.playfield_rows:
@@ -350,13 +677,14 @@ class BoulderWindow(tkinter.Tk):
                 self.cscore_tiles.append(tile)
         self.tilesheet = tiles.Tilesheet(self.playfield_columns, self.playfield_rows, self.visible_columns, self.visible_rows)
 
+    @in_gui_thread
     def set_screen_colors(self, screencolorrgb: int, bordercolorrgb: int) -> None:
         if self.c64colors:
             self.configure(background="#{:06x}".format(bordercolorrgb))
             self.canvas.configure(background="#{:06x}".format(screencolorrgb))
 
     def set_canvas_tile(self, x: int, y: int, obj: objects.GameObject) -> None:
-        self.tilesheet[x, y] = obj.tile()
+        self.tilesheet[x, y] = self.shared_animation_tiles.get(obj) or obj.tile()
 
     def set_scorebar_tiles(self, x: int, y: int, tiles: Sequence[int]) -> None:
         self.tilesheet_score.set_tiles(x, y, tiles)
@@ -364,10 +692,13 @@ class BoulderWindow(tkinter.Tk):
     def clear_tilesheet(self) -> None:
         self.tilesheet.set_tiles(0, 0, [objects.DIRT2.tile()] * self.playfield_columns * self.playfield_rows)
 
+    @in_gui_thread
     def prepare_reveal(self) -> None:
-        c = objects.COVERED.tile()
+        # all covered tiles show the same dynamic cover tile, that is animated as a whole
+        self.tile_images.set_dynamic_tile(self.cover_tile, objects.COVERED.tile())
+        cover_image = self.tile_images[self.cover_tile]
         for c_tile in self.c_tiles:
-            self.canvas.itemconfigure(c_tile, image=self.tile_images[c])
+            self.canvas.itemconfigure(c_tile, image=cover_image)
         self.tiles_revealed = bytearray(len(self.c_tiles))
 
     def do_reveal(self) -> None:
@@ -378,15 +709,28 @@ class BoulderWindow(tkinter.Tk):
         for _ in range(0, times):
             for y in range(0, self.playfield_rows):
                 x = random.randrange(0, self.playfield_columns)
-                tile = self.tilesheet[x, y]
                 idx = x + self.playfield_columns * y
-                self.tiles_revealed[idx] = 1
-                self.canvas.itemconfigure(self.c_tiles[idx], image=self.tile_images[tile])
+                if not self.tiles_revealed[idx]:
+                    self.tiles_revealed[idx] = 1
+                    self.canvas.itemconfigure(self.c_tiles[idx], image=self.tile_images[self.tilesheet[x, y]])
         # animate the cover-tiles
-        cover_tile = objects.COVERED.tile(self.graphics_frame)
-        for i, c_tile in enumerate(self.c_tiles):
-            if self.tiles_revealed[i] == 0:
-                self.canvas.itemconfigure(c_tile, image=self.tile_images[cover_tile])
+        self.tile_images.set_dynamic_tile(self.cover_tile, objects.COVERED.tile(self.graphics_frame))
+
+    def update_shared_animations(self) -> None:
+        for obj, tile in self.shared_animation_tiles.items():
+            animframe = int(obj.sfps / self.update_fps * self.graphics_frame)
+            self.tile_images.set_dynamic_tile(tile, obj.tile(animframe))
+
+    def update_magicwall_tiles(self) -> None:
+        magicwall_active = bool(self.gamestate.magicwall["active"])
+        if magicwall_active != self.magicwall_shown_active:
+            # the logic draws an inactive magic wall as brick, so switch those cells over (only when it changes)
+            tile = self.shared_animation_tiles[objects.MAGICWALL] if magicwall_active else objects.BRICK.tile()
+            cave = self.gamestate.cave
+            for index in self.gamestate.magicwall_cells:
+                cell = cave[index]
+                self.tilesheet[cell.x, cell.y] = tile
+            self.magicwall_shown_active = magicwall_active
 
     def physcoor(self, sx: int, sy: int) -> Tuple[int, int]:
         return int(sx * self.scalexy), int(sy * self.scalexy)
@@ -519,6 +863,7 @@ class BoulderWindow(tkinter.Tk):
             self.on_popup_closed()
             self.on_popup_closed = None
 
+    @in_gui_thread
     def ask_highscore_name(self, score_pos: int, score: int) -> str:
         username = bdcff.get_system_username()[:HighScores.max_namelen]
         while True:
@@ -531,7 +876,48 @@ class BoulderWindow(tkinter.Tk):
                 return name
 
 
+def font_scale(scalexy: float, smallwindow: bool) -> float:
+    return scalexy if smallwindow else 2 * scalexy
+
+
+def load_tile_atlases(c64colors: bool, c64_alternate_tiles: bool, scalexy: float, smallwindow: bool) -> Tuple[bytes, bytes]:
+    # Returns the image data of the sprite atlas (indexed, for c64 colors) and the font atlas.
+    # This doesn't use tkinter so it can run in a background thread.
+    if c64colors:
+        sprite_atlas = tiles.load_indexed_sprite_atlas(scalexy, c64_alternate_tiles)
+    else:
+        sprite_atlas = tiles.load_sprite_atlas(None, scale=scalexy)
+    return sprite_atlas, tiles.load_font_atlas(font_scale(scalexy, smallwindow))
+
+
+class Splash(tkinter.Toplevel):
+    """Small window that shows the progress of preparing the assets, until the (hidden) game window can be shown."""
+    def __init__(self, master: tkinter.Tk, title: str) -> None:
+        super().__init__(master)
+        self.title(title)
+        self.resizable(False, False)
+        self.configure(background="black", padx=20, pady=20)
+        self.label = tkinter.Label(self, text="Loading...", foreground="white", background="black")
+        self.label.pack()
+        self.bar = tkinter.Canvas(self, width=300, height=10, background="black", highlightthickness=1)
+        self.bar.pack(pady=(10, 0))
+        self.bar_fill = self.bar.create_rectangle(0, 0, 0, 10, fill="#ffcc00", width=0)
+        self.protocol("WM_DELETE_WINDOW", self.cancel)
+        self.cancelled = False
+
+    def cancel(self) -> None:
+        self.cancelled = True
+
+    def show_progress(self, done: int, total: int) -> None:
+        if self.cancelled:
+            raise SystemExit("startup cancelled")
+        self.label.configure(text="Loading... {:d}/{:d}".format(done, total))
+        self.bar.coords(self.bar_fill, 0, 0, 300 * done // max(1, total), 10)
+        self.update()
+
+
 def start(sargs: Sequence[str]=None) -> None:
+    startup.profiler.mark("imports")
     if sargs is None:
         sargs = sys.argv[1:]
     import argparse
@@ -545,6 +931,14 @@ def start(sargs: Sequence[str]=None) -> None:
     ap.add_argument("-a", "--authentic", help="use C-64 colors AND limited window size", action="store_true")
     ap.add_argument("-y", "--synth", help="use synthesized sounds instead of samples", action="store_true")
     ap.add_argument("-l", "--level", help="select start level (cave number). When using this, no highscores will be recorded.", type=int, default=1)
+    ap.add_argument("-w", "--warmup", help="create all tile images in the background instead of when they're first used", action="store_true")
+    ap.add_argument("--voices", type=int, default=16,
+                    help="maximum number of sounds that are mixed at the same time, 0=unlimited (default=%(default)d)")
+    ap.add_argument("--sharedanims", help="animate all cells of amoeba, magic wall, flies etc. in the same phase (faster)", action="store_true")
+    ap.add_argument("--threaded", help="run the game logic in its own thread, separate from the screen updates", action="store_true")
+    ap.add_argument("--framestats", metavar="FILE", help="write frame time statistics to this json file on exit")
+    ap.add_argument("--trace", metavar="FILE", help="write a trace of the game, render and audio threads to this file (chrome trace format)")
+    ap.add_argument("--profile-startup", help="print how long each phase of the startup takes", action="store_true")
     ap.add_argument("--editor", help="run the cave editor instead of the game.", action="store_true")
     ap.add_argument("--playtest", help="playtest the cave.", action="store_true")
     args = ap.parse_args(sargs)
@@ -555,8 +949,14 @@ def start(sargs: Sequence[str]=None) -> None:
         editor.start()
         raise SystemExit
 
+    if args.trace:
+        tracing.start(args.trace)
+
+    startup.profiler.enabled = args.profile_startup
+
     # validate required libraries
     audio.check_api()
+    startup.profiler.mark("audio api probe")
     args.c64colors |= args.authentic
     if args.c64colors:
         print("Using the original Commodore-64 colors.")
@@ -599,62 +999,115 @@ def start(sargs: Sequence[str]=None) -> None:
         "timeout8": ("timeout8.ogg", 1),
         "timeout9": ("timeout9.ogg", 1),
     }
+    # when more sounds play than the voice budget allows, the ones with the lowest priority are stopped first
+    sample_priorities = {
+        "music": 10, "cover": 10, "game_over": 10, "finished": 10, "extra_life": 9,
+        "amoeba": 8, "magic_wall": 8, "slime": 3,
+        "explosion": 6, "voodoo_explosion": 6, "collect_diamond": 5,
+        "walk_empty": 4, "walk_dirt": 4, "box_push": 4,
+        "crack": 2, "boulder": 1
+    }
+    sample_priorities.update({"timeout" + str(n): 9 for n in range(1, 10)})
+    sample_priorities.update({"diamond" + str(n): 1 for n in range(1, 7)})
 
     if args.synth:
-        print("Pre-synthesizing sounds...")
+        from . import synthsamples     # only imported when needed, it's a large module
         diamond = synthsamples.Diamond()   # is randomized everytime it is played
-        synthesized = {
-            "music": synthsamples.TitleMusic(),
-            "cover": synthsamples.Cover(),
-            "crack": synthsamples.Crack(),
-            "boulder": synthsamples.Boulder(),
-            "amoeba": synthsamples.Amoeba(),
-            "slime": synthsamples.Slime(),
-            "magic_wall": synthsamples.MagicWall(),
-            "finished": synthsamples.Finished(),
-            "explosion": synthsamples.Explosion(),
-            "voodoo_explosion": synthsamples.VoodooExplosion(),
-            "collect_diamond": synthsamples.CollectDiamond(),
-            "walk_empty": synthsamples.WalkEmpty(),
-            "walk_dirt": synthsamples.WalkDirt(),
-            "box_push": synthsamples.BoxPush(),
-            "extra_life": synthsamples.ExtraLife(),
-            "game_over": synthsamples.GameOver(),
-            "diamond1": diamond,
-            "diamond2": diamond,
-            "diamond3": diamond,
-            "diamond4": diamond,
-            "diamond5": diamond,
-            "diamond6": diamond,
-            "timeout1": synthsamples.Timeout(1),
-            "timeout2": synthsamples.Timeout(2),
-            "timeout3": synthsamples.Timeout(3),
-            "timeout4": synthsamples.Timeout(4),
-            "timeout5": synthsamples.Timeout(5),
-            "timeout6": synthsamples.Timeout(6),
-            "timeout7": synthsamples.Timeout(7),
-            "timeout8": synthsamples.Timeout(8),
-            "timeout9": synthsamples.Timeout(9),
-        }
-        assert len(synthesized.keys() - samples.keys()) == 0
-        missing = samples.keys() - synthesized.keys()
+        synthesizers = {
+            "music": synthsamples.TitleMusic,
+            "cover": synthsamples.Cover,
+            "crack": synthsamples.Crack,
+            "boulder": synthsamples.Boulder,
+            "amoeba": synthsamples.Amoeba,
+            "slime": synthsamples.Slime,
+            "magic_wall": synthsamples.MagicWall,
+            "finished": synthsamples.Finished,
+            "explosion": synthsamples.Explosion,
+            "voodoo_explosion": synthsamples.VoodooExplosion,
+            "collect_diamond": synthsamples.CollectDiamond,
+            "walk_empty": synthsamples.WalkEmpty,
+            "walk_dirt": synthsamples.WalkDirt,
+            "box_push": synthsamples.BoxPush,
+            "extra_life": synthsamples.ExtraLife,
+            "game_over": synthsamples.GameOver,
+            "diamond1": lambda: diamond,
+            "diamond2": lambda: diamond,
+            "diamond3": lambda: diamond,
+            "diamond4": lambda: diamond,
+            "diamond5": lambda: diamond,
+            "diamond6": lambda: diamond,
+            "timeout1": functools.partial(synthsamples.Timeout, 1),
+            "timeout2": functools.partial(synthsamples.Timeout, 2),
+            "timeout3": functools.partial(synthsamples.Timeout, 3),
+            "timeout4": functools.partial(synthsamples.Timeout, 4),
+            "timeout5": functools.partial(synthsamples.Timeout, 5),
+            "timeout6": functools.partial(synthsamples.Timeout, 6),
+            "timeout7": functools.partial(synthsamples.Timeout, 7),
+            "timeout8": functools.partial(synthsamples.Timeout, 8),
+            "timeout9": functools.partial(synthsamples.Timeout, 9),
+        }   # type: Dict[str, Callable[[], sample.Sample]]
+        assert len(synthesizers.keys() - samples.keys()) == 0
+        missing = samples.keys() - synthesizers.keys()
         if missing:
             raise SystemExit("Synths missing for: " + str(missing))
-        for name, sample in synthesized.items():
-            max_simul = samples[name][1]
-            samples[name] = (sample, max_simul)     # type: ignore
 
     if os.name == "nt":
         audio.prepare_oggdec_exe()
-    audio.init_audio(samples)
+    sound_engine = audio.init_audio({})
+    sound_engine.set_voice_budget(args.voices, sample_priorities)
+    startup.profiler.mark("audio initialization")
+    # The sounds and the tile images are prepared concurrently in the background.
+    # The game starts as soon as the assets for the title screen are ready, the other sounds are added when they're done.
+    assets = warmup.AssetWarmup()
+    assets.submit("tiles", load_tile_atlases, args.c64colors, args.othertiles, (args.size + 1) / 2, args.authentic)
+    sample_bank = sample_bank_key = None
+    if not args.synth:
+        # all decoded sound files are stored together in a memory mapped sample bank, that loads almost instantly
+        sample_bank_key = audio.sample_bank_key({name: filename for name, (filename, _) in samples.items()})
+        sample_bank = audio.load_sample_bank(sample_bank_key)
+    if sample_bank:
+        for name, (_, max_simultaneously) in samples.items():
+            sound_engine.add_sample(name, sample_bank[name], max_simultaneously)
+    else:
+        print("Synthesizing sounds..." if args.synth else "Loading sound files...")
+        for name, (filename, max_simultaneously) in samples.items():
+            def add_sample(name: str, smp: sample.Sample, max_simultaneously: int=max_simultaneously) -> None:
+                sound_engine.add_sample(name, smp, max_simultaneously)
+            if args.synth:
+                assets.submit(name, synthesizers[name], when_done=add_sample)
+            else:
+                assets.submit(name, audio.load_sample, name, filename, when_done=add_sample)
+        if sample_bank_key:
+            assets.when_all_done(samples, lambda: audio.store_sample_bank(
+                sample_bank_key, {name: audio.samples[name] for name in samples}))     # type: ignore
     title = "Boulder Caves {version:s} {sound:s} {playtest:s} - by Irmen de Jong"\
         .format(version=__version__,
                 sound="[using synthesizer]" if args.synth else "",
                 playtest="[playtesting]" if args.playtest else "")
+
+    def wait_for_tiles(window: tkinter.Tk) -> Tuple[bytes, bytes]:
+        splash = Splash(window, title)
+        try:
+            assets.wait(["tiles"] if sample_bank else ["tiles", "music"], splash.show_progress)
+        except BaseException:
+            # don't keep decoding the other sounds when the game isn't going to start
+            assets.shutdown(cancel=True)
+            raise
+        finally:
+            splash.destroy()
+        assets.shutdown()
+        startup.profiler.mark("title screen assets")
+        return assets.result("tiles")
+
     window = BoulderWindow(title, args.fps, args.size + 1,
                            c64colors=args.c64colors | args.authentic,
                            c64_alternate_tiles=args.othertiles,
-                           smallwindow=args.authentic)
+                           smallwindow=args.authentic,
+                           warm_up_tiles=args.warmup,
+                           shared_animations=args.sharedanims,
+                           threaded_logic=args.threaded,
+                           frame_stats_file=args.framestats,
+                           wait_for_tiles=wait_for_tiles)
     if args.game:
         window.gamestate.use_bdcff(args.game)
     if args.level:
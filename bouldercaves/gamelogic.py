@@ -11,9 +11,9 @@ import datetime
 import random
 import json
 from enum import Enum
-from typing import List, Optional, Sequence, Generator
+from typing import List, Optional, Sequence, Generator, Container, Set, Callable
 from .objects import Direction
-from . import caves, audio, user_data_dir, tiles, objects
+from . import caves, audio, user_data_dir, tiles, objects, tracing
 
 
 class GameStatus(Enum):
@@ -152,12 +152,18 @@ class GameState:
         self.caveset = caves.CaveSet()
         self.start_level_number = 1
         self.reveal_duration = 3.0
+        self.clock = datetime.datetime.now     # type: Callable[[], datetime.datetime]   # can be replaced by a fixed frame clock
         # set the anim end callbacks:
         objects.ROCKFORDBIRTH.anim_end_callback = self.end_rockfordbirth
         objects.EXPLOSION.anim_end_callback = self.end_explosion
         objects.DIAMONDBIRTH.anim_end_callback = self.end_diamondbirth
         self.highscores = HighScores(self.caveset.name)
         self.playtesting = False
+        # cheap performance counters of the last update, shown in the debug overlay
+        # (the get() calls are only counted while count_get_calls is enabled)
+        self.active_cells = 0
+        self.get_calls = 0
+        self.last_get_calls = 0
         # and start the game on the title screen.
         self.restart()
 
@@ -269,6 +275,8 @@ class GameState:
             Direction.RIGHTDOWN: self.width + 1
         }
         self.cave = []   # type: List[Cell]
+        self.animated_cells = set()     # type: Set[int]   # indexes of the cells with an animated object
+        self.magicwall_cells = set()    # type: Set[int]   # indexes of the cells with a magic wall
         for y in range(self.height):
             for x in range(self.width):
                 self.cave.append(Cell(objects.EMPTY, x, y))
@@ -292,6 +300,7 @@ class GameState:
         self.reveal_duration = 0.0
         self.load_next_level(False)
 
+    @tracing.traced("load_level")
     def load_level(self, levelnumber: int, level_intro_popup: bool=True) -> None:
         audio.silence_audio()
         self.game.popup_close()    # make sure any open popup won't restore the old tiles
@@ -406,11 +415,11 @@ class GameState:
 
     def pause(self) -> None:
         if self.game_status == GameStatus.PLAYING:
-            self.time_paused = datetime.datetime.now()
+            self.time_paused = self.clock()
             self.game_status = GameStatus.PAUSED
         elif self.game_status == GameStatus.PAUSED:
             if self.timelimit:
-                pause_duration = datetime.datetime.now() - self.time_paused
+                pause_duration = self.clock() - self.time_paused
                 self.timelimit = self.timelimit + pause_duration
             self.game_status = GameStatus.PLAYING
 
@@ -455,7 +464,16 @@ class GameState:
         self.draw_single_cell(self.cave[x + y * self.width], obj, initial_direction)
 
     def draw_single_cell(self, cell: Cell, obj: objects.GameObject, initial_direction: Direction=Direction.NOWHERE) -> None:
+        index = cell.x + cell.y * self.width
+        if obj is objects.MAGICWALL:
+            self.magicwall_cells.add(index)
+        elif cell.obj is objects.MAGICWALL:
+            self.magicwall_cells.discard(index)
         cell.obj = obj
+        if obj.sframes:
+            self.animated_cells.add(index)
+        else:
+            self.animated_cells.discard(index)
         cell.direction = initial_direction
         cell.frame = self.frame   # make sure the new cell is not immediately scanned
         cell.anim_start_gfx_frame = self.graphics_frame_counter   # this makes sure that (new) anims start from the first frame
@@ -482,6 +500,18 @@ class GameState:
             return Cell(objects.STEEL, cell.x, cell.y)   # treat upper/lower edge as steel wall
         return self.cave[cell_index]
 
+    def _counting_get(self, cell: Cell, direction: Direction=Direction.NOWHERE) -> Cell:
+        self.get_calls += 1
+        return GameState.get(self, cell, direction)
+
+    def count_get_calls(self, enabled: bool) -> None:
+        # get() is called very often, so the calls are only counted (by a replacement get) when they're shown
+        if enabled:
+            self.get = self._counting_get    # type: ignore
+        else:
+            self.__dict__.pop("get", None)
+        self.get_calls = self.last_get_calls = 0
+
     def move(self, cell: Cell, direction: Direction=Direction.NOWHERE) -> Optional[Cell]:
         # move the object in the cell to the given relative direction
         if direction == Direction.NOWHERE:
@@ -543,52 +573,79 @@ class GameState:
                 self.draw_single_cell(cell_under_wall, obj)
                 cell_under_wall.falling = True
 
-    def cells_with_animations(self) -> List[Cell]:
-        return [cell for cell in self.cave if cell.obj.sframes]
+    def update_animations(self, tilesheet: tiles.Tilesheet, graphics_frame: int, update_fps: int,
+                          exclude: Container[objects.GameObject]=()) -> None:
+        # The animation part of a screen update: puts the current frame of the animated cells in the tilesheet
+        # (except the excluded objects, that the screen animates itself).
+        # The end of some animations (like an explosion) drives the game logic.
+        cave = self.cave
+        # a list, because the animation end callbacks change the set of animated cells
+        for cell in [cave[index] for index in self.animated_cells if cave[index].obj not in exclude]:
+            obj = cell.obj
+            if obj is objects.MAGICWALL and not self.magicwall["active"]:
+                obj = objects.BRICK
+            animframe = int(obj.sfps / update_fps * (graphics_frame - cell.anim_start_gfx_frame))
+            tilesheet[cell.x, cell.y] = obj.tile(animframe)
+            if animframe >= obj.sframes and obj.anim_end_callback:
+                # the animation reached the last frame
+                obj.anim_end_callback(cell)
 
+    @tracing.traced("update")
     def update(self, graphics_frame_counter: int) -> None:
-        self.graphics_frame_counter = graphics_frame_counter    # we store this to properly sync up animation frames
-        self.frame_start()
-        if self.game_status in (GameStatus.REVEALING_DEMO, GameStatus. REVEALING_PLAY):
-            if self.reveal_frame > self.frame:
+        # the sounds of one logic frame are collected, and played together when the frame is done
+        audio.begin_sound_batch()
+        try:
+            self.last_get_calls = self.get_calls
+            self.get_calls = 0
+            self.graphics_frame_counter = graphics_frame_counter    # we store this to properly sync up animation frames
+            self.frame_start()
+            if self.game_status in (GameStatus.REVEALING_DEMO, GameStatus. REVEALING_PLAY):
+                if self.reveal_frame > self.frame:
+                    return
+                # reveal period has ended
+                audio.silence_audio("cover")
+                self.game.tilesheet.all_dirty()  # force full redraw
+                if self.game_status == GameStatus.REVEALING_DEMO:
+                    self.game_status = GameStatus.DEMO
+                elif self.game_status == GameStatus.REVEALING_PLAY:
+                    self.game_status = GameStatus.PLAYING
+            if self.game_status not in (GameStatus.PLAYING, GameStatus.DEMO):
                 return
-            # reveal period has ended
-            audio.silence_audio("cover")
-            self.game.tilesheet.all_dirty()  # force full redraw
-            if self.game_status == GameStatus.REVEALING_DEMO:
-                self.game_status = GameStatus.DEMO
-            elif self.game_status == GameStatus.REVEALING_PLAY:
-                self.game_status = GameStatus.PLAYING
-        if self.game_status not in (GameStatus.PLAYING, GameStatus.DEMO):
-            return
-        if not self.level_won:
-            # sweep the cave
-            for cell in self.cave:
-                if cell.frame < self.frame:
-                    if cell.falling:
-                        self.update_falling(cell)
-                    elif cell.canfall():
-                        self.update_canfall(cell)
-                    elif cell.isfirefly():
-                        self.update_firefly(cell)
-                    elif cell.isbutterfly():
-                        self.update_butterfly(cell)
-                    elif cell.obj is objects.INBOXBLINKING:
-                        self.update_inbox(cell)
-                    elif cell.isrockford():
-                        self.update_rockford(cell)
-                    elif cell.isamoeba():
-                        self.update_amoeba(cell)
-                    elif cell.obj is objects.OUTBOXCLOSED:
-                        self.update_outboxclosed(cell)
-                    elif cell.obj is objects.OUTBOXHIDDEN:
-                        self.update_outboxhidden(cell)
-                    elif cell.obj is objects.BONUSBG:
-                        if self.bonusbg_frame < self.frame:
-                            self.draw_single_cell(cell, objects.EMPTY)
-                    elif cell.obj in (objects.HEXPANDINGWALL, objects.VEXPANDINGWALL):
-                        self.update_expandingwall(cell)
-        self.frame_end()
+            if not self.level_won:
+                # sweep the cave
+                active_cells = 0
+                for cell in self.cave:
+                    if cell.frame < self.frame:
+                        if cell.falling:
+                            self.update_falling(cell)
+                        elif cell.canfall():
+                            self.update_canfall(cell)
+                        elif cell.isfirefly():
+                            self.update_firefly(cell)
+                        elif cell.isbutterfly():
+                            self.update_butterfly(cell)
+                        elif cell.obj is objects.INBOXBLINKING:
+                            self.update_inbox(cell)
+                        elif cell.isrockford():
+                            self.update_rockford(cell)
+                        elif cell.isamoeba():
+                            self.update_amoeba(cell)
+                        elif cell.obj is objects.OUTBOXCLOSED:
+                            self.update_outboxclosed(cell)
+                        elif cell.obj is objects.OUTBOXHIDDEN:
+                            self.update_outboxhidden(cell)
+                        elif cell.obj is objects.BONUSBG:
+                            if self.bonusbg_frame < self.frame:
+                                self.draw_single_cell(cell, objects.EMPTY)
+                        elif cell.obj in (objects.HEXPANDINGWALL, objects.VEXPANDINGWALL):
+                            self.update_expandingwall(cell)
+                        else:
+                            continue
+                        active_cells += 1
+                self.active_cells = active_cells
+            self.frame_end()
+        finally:
+            audio.end_sound_batch()
 
     def frame_start(self) -> None:
         # called at beginning of every game logic update
@@ -627,7 +684,7 @@ class GameState:
             self.magicwall["active"] = still_magic
         if self.timelimit and not self.level_won and self.rockford_cell:
             secs_before = self.timeremaining.seconds
-            self.timeremaining = self.timelimit - datetime.datetime.now()
+            self.timeremaining = self.timelimit - self.clock()
             secs_after = self.timeremaining.seconds
             if secs_after <= 0:
                 self.timeremaining = datetime.timedelta(0)
@@ -1012,7 +1069,7 @@ class GameState:
         # rockfordbirth eventually creates the real Rockford and starts the level timer.
         if self.game_status in (GameStatus.PLAYING, GameStatus.DEMO):
             self.draw_single_cell(cell, objects.ROCKFORD)
-            self.timelimit = datetime.datetime.now() + self.timeremaining
+            self.timelimit = self.clock() + self.timeremaining
             self.inbox_cell = None
             if self.diamonds_needed <= 0:
                 # need to subtract this from the current number of diamonds in the cave
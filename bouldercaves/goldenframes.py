@@ -0,0 +1,156 @@
+"""
+Boulder Caves - a Boulder Dash (tm) clone.
+
+Golden-frame regression test of the game logic.
+Plays the built-in demo, and every recorded replay, headless with a fixed random seed
+and a fixed frame clock. For every logic frame a hash of the game state and a hash of
+the tile sheet are recorded and compared against the stored golden files, so changes
+to the game logic or the tile sheet can be checked to be bit-identical in behavior.
+
+A replay is a json file in the replays directory, looking like this:
+  {"caveset": "amoeba.bd", "level": 1, "seed": 1, "moves": [255, 87, 0]}
+caveset is a bdcff file relative to the replay file (or empty for the built-in caves),
+moves are encoded like the built-in demo: repeat count in the upper 4 bits, direction in the lower 4 bits.
+
+Usage:  python -m bouldercaves.goldenframes [--update] [names]
+
+Written by Irmen de Jong (irmen@razorvine.net)
+License: GNU GPL 3.0, see LICENSE
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import random
+import hashlib
+import datetime
+from typing import Dict, List, Optional
+from .gamelogic import GameStatus, DemoMovementInfo
+from .headless import HeadlessGame
+
+
+testcaves_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "testcaves")
+golden_dir = os.path.join(testcaves_dir, "golden")
+replays_dir = os.path.join(testcaves_dir, "replays")
+demo_seed = 42
+max_frames = 5000
+frames_after_replay = 30    # keep running a bit after the last move, to see the results of it
+
+
+class Run:
+    """A headless game run that records the per-frame hashes."""
+    def __init__(self, seed: int, caveset: Optional[str]=None) -> None:
+        self.game = HeadlessGame()
+        self.gamestate = self.game.gamestate
+        if caveset:
+            self.gamestate.use_bdcff(caveset)
+        self.start_time = datetime.datetime(2000, 1, 1)
+        self.gamestate.clock = self.frame_clock
+        self.frames = []    # type: List[str]
+        random.seed(seed)
+
+    def frame_clock(self) -> datetime.datetime:
+        # the time advances exactly one timestep per logic frame
+        return self.start_time + datetime.timedelta(seconds=self.gamestate.frame * self.gamestate.update_timestep)
+
+    def update(self) -> None:
+        self.game.update()
+        self.frames.append(self.state_hash() + ":" + self.tiles_hash())
+
+    def state_hash(self) -> str:
+        gs = self.gamestate
+        digest = hashlib.sha1()
+        digest.update("{:d} {:s} {:d} {:d} {:d} {:d} {:d}".format(gs.level, gs.game_status.name, gs.frame, gs.score, gs.lives,
+                                                                  gs.diamonds, gs.timeremaining.seconds).encode())
+        digest.update("|".join("{:s}{:d}{:s}".format(cell.obj.name, cell.falling, cell.direction.value)
+                               for cell in gs.cave).encode())
+        return digest.hexdigest()[:16]
+
+    def tiles_hash(self) -> str:
+        digest = hashlib.sha1(self.game.tilesheet.tiles.tobytes())
+        digest.update(self.game.tilesheet_score.tiles.tobytes())
+        return digest.hexdigest()[:16]
+
+
+def play_demo() -> List[str]:
+    run = Run(demo_seed)
+    run.gamestate.start_demo()
+    for _ in range(max_frames):
+        run.update()
+        if run.gamestate.game_status == GameStatus.WAITING:
+            break   # the demo has ended and the game is back on the title screen
+    return run.frames
+
+
+def play_replay(filename: str) -> List[str]:
+    with open(filename, "rt") as f:
+        replay = json.load(f)
+    caveset = os.path.join(os.path.dirname(filename), replay["caveset"]) if replay.get("caveset") else None
+    run = Run(replay.get("seed", 0), caveset)
+    run.gamestate.load_level(replay.get("level", 1), level_intro_popup=False)
+    movement = run.gamestate.movement = DemoMovementInfo(replay["moves"])
+    frames_left = frames_after_replay
+    for _ in range(max_frames):
+        run.update()
+        if run.gamestate.movement is not movement or run.gamestate.game_status in (GameStatus.WAITING, GameStatus.LOST):
+            break   # level ended
+        if movement.demo_finished:
+            frames_left -= 1
+            if not frames_left:
+                break
+    return run.frames
+
+
+def all_runs() -> Dict[str, str]:
+    # name -> replay file (an empty name for the built-in demo)
+    runs = {"bd1demo": ""}
+    for filename in sorted(glob.glob(os.path.join(replays_dir, "*.json"))):
+        runs[os.path.splitext(os.path.basename(filename))[0]] = filename
+    return runs
+
+
+def check(name: str, frames: List[str], update: bool) -> bool:
+    golden_file = os.path.join(golden_dir, name + ".json")
+    if update or not os.path.exists(golden_file):
+        os.makedirs(golden_dir, exist_ok=True)
+        with open(golden_file, "wt") as out:
+            json.dump({"frames": frames}, out, indent=0)
+        print("  golden file written:", golden_file)
+        return True
+    with open(golden_file, "rt") as f:
+        golden = json.load(f)["frames"]
+    for frame, (expected, actual) in enumerate(zip(golden, frames), start=1):
+        if expected != actual:
+            state_ok = expected.split(":")[0] == actual.split(":")[0]
+            print("  MISMATCH at frame {:d}: {:s} differs".format(frame, "tile sheet" if state_ok else "game state"))
+            return False
+    if len(golden) != len(frames):
+        print("  MISMATCH: expected {:d} frames, got {:d}".format(len(golden), len(frames)))
+        return False
+    print("  ok")
+    return True
+
+
+def main(args: Optional[List[str]]=None) -> None:
+    import argparse
+    ap = argparse.ArgumentParser(description="Boulder Caves golden-frame regression test")
+    ap.add_argument("-u", "--update", help="write new golden files instead of checking against them", action="store_true")
+    ap.add_argument("names", nargs="*", help="only run these (default=all)")
+    parsed = ap.parse_args(args)
+    all_ok = True
+    for name, replay_file in all_runs().items():
+        if parsed.names and name not in parsed.names:
+            continue
+        start = time.perf_counter()
+        frames = play_replay(replay_file) if replay_file else play_demo()
+        duration = time.perf_counter() - start
+        print("{:s}: {:d} frames, {:.0f} frames/sec".format(name, len(frames), len(frames) / duration))
+        all_ok &= check(name, frames, parsed.update)
+    if not all_ok:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
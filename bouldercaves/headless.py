@@ -0,0 +1,86 @@
+"""
+Boulder Caves - a Boulder Dash (tm) clone.
+
+Runs the game logic without a screen and without sound,
+for benchmarks and regression tests.
+
+Written by Irmen de Jong (irmen@razorvine.net)
+License: GNU GPL 3.0, see LICENSE
+"""
+
+from typing import Callable, Sequence
+from .gamelogic import GameState, GameStatus
+from . import audio, tiles, objects
+from .caves import Palette
+
+
+class HeadlessGame:
+    """
+    Stands in for the game window (BoulderWindow) to drive a GameState.
+    It keeps the tilesheets up to date, but doesn't display anything.
+    Popups are closed immediately.
+    """
+    visible_columns = 40
+    visible_rows = 22
+    update_fps = 30
+
+    def __init__(self) -> None:
+        if audio.sound_engine is None:
+            audio.init_silent_audio()
+        self.smallwindow = False
+        self.c64colors = False
+        self.graphics_frame = 0
+        self.logic_frame = 0
+        self.playfield_columns = self.playfield_rows = 0
+        self.tilesheet = tiles.Tilesheet(self.visible_columns, self.visible_rows, self.visible_columns, self.visible_rows)
+        self.tilesheet_score = tiles.Tilesheet(self.visible_columns, 2, self.visible_columns, 2)
+        self.gamestate = GameState(self)
+
+    def update(self) -> None:
+        # one game logic update, followed by the graphics frames that would be shown until the next logic update
+        self.gamestate.update(self.graphics_frame)
+        self.gamestate.update_scorebar()
+        self.logic_frame += 1
+        while self.graphics_frame < self.logic_frame * self.update_fps // self.gamestate.fps:
+            self.graphics_frame += 1
+            self.gamestate.update_animations(self.tilesheet, self.graphics_frame, self.update_fps)
+
+    def start_level(self, levelnumber: int) -> None:
+        # loads the level and skips the reveal so the game logic is running immediately
+        self.gamestate.reveal_duration = 0.0
+        self.gamestate.load_level(levelnumber, level_intro_popup=False)
+        self.gamestate.game_status = GameStatus.PLAYING
+
+    def set_canvas_tile(self, x: int, y: int, obj: objects.GameObject) -> None:
+        self.tilesheet[x, y] = obj.tile()
+
+    def set_scorebar_tiles(self, x: int, y: int, tiles: Sequence[int]) -> None:
+        self.tilesheet_score.set_tiles(x, y, tiles)
+
+    def clear_tilesheet(self) -> None:
+        self.tilesheet.set_tiles(0, 0, [objects.DIRT2.tile()] * self.playfield_columns * self.playfield_rows)
+
+    def create_canvas_playfield_and_tilesheet(self, width: int, height: int) -> None:
+        if width != self.playfield_columns or height != self.playfield_rows:
+            self.playfield_columns = width
+            self.playfield_rows = height
+            self.tilesheet = tiles.Tilesheet(width, height, self.visible_columns, self.visible_rows)
+
+    def create_colored_tiles(self, colors: Palette) -> None:
+        pass
+
+    def set_screen_colors(self, screencolorrgb: int, bordercolorrgb: int) -> None:
+        pass
+
+    def prepare_reveal(self) -> None:
+        pass
+
+    def popup(self, text: str, duration: float=5.0, on_close: Callable=None) -> None:
+        if on_close:
+            on_close()
+
+    def popup_close(self) -> None:
+        pass
+
+    def ask_highscore_name(self, score_pos: int, score: int) -> str:
+        return "headless"
@@ -0,0 +1,48 @@
+"""
+Boulder Caves - a Boulder Dash (tm) clone.
+
+Startup time profiling: measures how long each phase of the startup takes,
+up to the moment the first frame is shown on the screen.
+
+Written by Irmen de Jong (irmen@razorvine.net)
+License: GNU GPL 3.0, see LICENSE
+"""
+
+import time
+from collections import OrderedDict
+
+
+class StartupProfiler:
+    """
+    Records the time between marks, per phase. Marking is always done (it is cheap),
+    the breakdown is only printed when the profiler is enabled.
+    """
+    def __init__(self) -> None:
+        self.enabled = False
+        self.start_time = self.last_mark = time.perf_counter()
+        self.phases = OrderedDict()    # type: OrderedDict[str, float]
+        self.first_frame_shown = False
+
+    def mark(self, phase: str) -> None:
+        """Records the time since the previous mark as spent in the given phase."""
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self.last_mark
+        self.last_mark = now
+
+    def first_frame(self) -> None:
+        if self.first_frame_shown:
+            return
+        self.first_frame_shown = True
+        self.mark("first frame")
+        if self.enabled:
+            self.report()
+
+    def report(self) -> None:
+        print("Startup time profile:")
+        for phase, duration in self.phases.items():
+            print("  {:24s} {:8.1f} ms".format(phase, duration * 1000))
+        print("  {:24s} {:8.1f} ms".format("total to first frame", (self.last_mark - self.start_time) * 1000))
+
+
+# started when the bouldercaves package is imported
+profiler = StartupProfiler()
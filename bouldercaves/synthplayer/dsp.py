@@ -0,0 +1,474 @@
+"""
+Basic digital signal processing operations on raw sample frame data
+(signed integers of 1, 2, 3 or 4 bytes in native byte order, the same as the audioop module).
+The audioop module is deprecated and has been removed in Python 3.13, so these are used instead.
+The operations are vectorized with numpy if it is available. Otherwise audioop is used
+if it still exists, and as a last resort they're done in pure Python with the array module.
+
+Written by Irmen de Jong (irmen@razorvine.net) - License: GNU LGPL 3.
+"""
+
+import sys
+import math
+import array
+import warnings
+from typing import Any, Iterable, List, Optional, Sequence, Tuple, Union
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        import audioop
+except ImportError:
+    audioop = None
+
+
+__all__ = ["backend", "use_backend", "MixBuffer", "add", "mix", "mul", "ramp", "bias", "tostereo", "tomono", "interleave",
+           "lin2lin", "byteswap", "reverse", "ratecv", "peak", "rms", "getsample"]
+
+
+Frames = Union[bytes, bytearray, memoryview]
+
+
+def _limits(width: int) -> Tuple[int, int]:
+    return -2**(8*width-1), 2**(8*width-1)-1
+
+
+def _ratecv_positions(numframes: int, inrate: int, outrate: int, state: Any,
+                      first_frame: List[int]) -> Tuple[float, List[int], float, int]:
+    # Linear interpolation over the fragment, preceded by the last frame of the previous fragment
+    # (at position 0), so consecutive fragments of a stream join up without a click at the edges.
+    # Like audioop, this delays the output by one frame. The state is the fractional position of
+    # the next output frame, and the last frame of the previous fragment.
+    # Returns the start position, the previous frame, the step between output frames, and their number.
+    position, previous = state or (0.0, first_frame)
+    step = inrate / outrate
+    return position, previous, step, max(0, math.ceil((numframes - position) / step))
+
+
+class _NumpyDsp:
+    name = "numpy"
+
+    def __init__(self) -> None:
+        self.dtypes = {1: numpy.int8, 2: numpy.int16, 4: numpy.int32}
+
+    def decode(self, frames: Frames, width: int) -> Any:
+        # always gives an int64 array, so calculations on the values can't overflow
+        if width == 3:
+            b = numpy.frombuffer(frames, dtype=numpy.uint8).reshape(-1, 3).astype(numpy.int64)
+            if sys.byteorder == "big":
+                b = b[:, ::-1]
+            values = b[:, 0] | (b[:, 1] << 8) | (b[:, 2] << 16)
+            return values - ((values & 0x800000) << 1)
+        return numpy.frombuffer(frames, dtype=self.dtypes[width]).astype(numpy.int64)
+
+    def encode(self, values: Any, width: int, clip: bool=True) -> bytes:
+        if clip:
+            values = numpy.clip(values, *_limits(width))
+        if width == 3:
+            b = values.astype("<i4").view(numpy.uint8).reshape(-1, 4)[:, :3]
+            if sys.byteorder == "big":
+                b = b[:, ::-1]
+            return b.tobytes()
+        return values.astype(self.dtypes[width]).tobytes()
+
+    def add(self, fragment1: Frames, fragment2: Frames, width: int) -> bytes:
+        return self.encode(self.decode(fragment1, width) + self.decode(fragment2, width), width)
+
+    def mix(self, fragments: Sequence[Frames], width: int) -> bytes:
+        accumulator = numpy.zeros(len(fragments[0]) // width, dtype=numpy.int32 if width <= 2 else numpy.int64)
+        for fragment in fragments:
+            if width == 3:
+                accumulator += self.decode(fragment, width)
+            else:
+                accumulator += numpy.frombuffer(fragment, dtype=self.dtypes[width])
+        return self.encode(accumulator, width)
+
+    def mul(self, fragment: Frames, width: int, factor: float) -> bytes:
+        return self.encode(numpy.floor(self.decode(fragment, width) * factor), width)
+
+    def bias(self, fragment: Frames, width: int, bias: int) -> bytes:
+        # like audioop, this wraps around instead of clipping
+        low, high = _limits(width)
+        return self.encode((self.decode(fragment, width) + bias - low) % (high - low + 1) + low, width, False)
+
+    def tostereo(self, fragment: Frames, width: int, lfactor: float, rfactor: float) -> bytes:
+        values = self.decode(fragment, width)
+        return self.encode(numpy.column_stack((numpy.floor(values * lfactor), numpy.floor(values * rfactor))).ravel(), width)
+
+    def tomono(self, fragment: Frames, width: int, lfactor: float, rfactor: float) -> bytes:
+        values = self.decode(fragment, width)
+        return self.encode(numpy.floor(values[0::2] * lfactor + values[1::2] * rfactor), width)
+
+    def interleave(self, left: Frames, right: Frames, width: int) -> bytes:
+        return self.encode(numpy.column_stack((self.decode(left, width), self.decode(right, width))).ravel(), width, False)
+
+    def ramp(self, fragment: Frames, width: int, start: float, end: float) -> bytes:
+        values = self.decode(fragment, width)
+        gains = start + numpy.arange(len(values)) * ((end - start) / max(1, len(values)))
+        return self.encode(numpy.trunc(values * gains), width)
+
+    def lin2lin(self, fragment: Frames, width: int, newwidth: int) -> bytes:
+        values = self.decode(fragment, width)
+        if newwidth > width:
+            values <<= 8 * (newwidth - width)
+        else:
+            values >>= 8 * (width - newwidth)
+        return self.encode(values, newwidth, False)
+
+    def byteswap(self, fragment: Frames, width: int) -> bytes:
+        return numpy.frombuffer(fragment, dtype=numpy.uint8).reshape(-1, width)[:, ::-1].tobytes()
+
+    def reverse(self, fragment: Frames, width: int) -> bytes:
+        return numpy.frombuffer(fragment, dtype=numpy.uint8).reshape(-1, width)[::-1].tobytes()
+
+    def ratecv(self, fragment: Frames, width: int, nchannels: int, inrate: int, outrate: int,
+               state: Any) -> Tuple[bytes, Any]:
+        values = self.decode(fragment, width).reshape(-1, nchannels)
+        if not len(values):
+            return b"", state
+        position, previous, step, count = _ratecv_positions(len(values), inrate, outrate, state, values[0].tolist())
+        extended = numpy.vstack((numpy.array(previous, dtype=numpy.int64), values))
+        positions = position + numpy.arange(count) * step
+        channels = [numpy.interp(positions, numpy.arange(len(extended)), extended[:, c]) for c in range(nchannels)]
+        converted = self.encode(numpy.floor(numpy.column_stack(channels).ravel()), width)
+        return converted, (position + count * step - len(values), values[-1].tolist())
+
+    def peak(self, fragment: Frames, width: int) -> int:
+        values = self.decode(fragment, width)
+        return int(numpy.abs(values).max()) if len(values) else 0
+
+    def rms(self, fragment: Frames, width: int) -> int:
+        values = self.decode(fragment, width).astype(numpy.float64)
+        return int(math.sqrt(numpy.dot(values, values) / len(values))) if len(values) else 0
+
+    def getsample(self, fragment: Frames, width: int, index: int) -> int:
+        return int(self.decode(fragment[index*width: index*width+width], width)[0])
+
+
+class _AudioopDsp:
+    name = "audioop"
+
+    def __init__(self) -> None:
+        for operation in ("add", "mul", "bias", "tostereo", "tomono", "lin2lin",
+                          "byteswap", "reverse", "rms", "getsample", "ratecv"):
+            setattr(self, operation, getattr(audioop, operation))
+        self.peak = audioop.max
+
+    def mix(self, fragments: Sequence[Frames], width: int) -> bytes:
+        if width == 4:
+            return _array_dsp.mix(fragments, width)     # there's no wider sample width to add them up in
+        # The fragments are widened to 32 bits but keep their values, so adding them up doesn't clip.
+        # Scaling the sum up to the full 32 bits clips it once, and then it's narrowed to the original width again.
+        scale = 1 << (8 * (4 - width))
+        mixed = audioop.mul(audioop.lin2lin(fragments[0], width, 4), 4, 1 / scale)
+        for fragment in fragments[1:]:
+            mixed = audioop.add(mixed, audioop.mul(audioop.lin2lin(fragment, width, 4), 4, 1 / scale), 4)
+        return audioop.lin2lin(audioop.mul(mixed, 4, scale), 4, width)
+
+    def interleave(self, left: Frames, right: Frames, width: int) -> bytes:
+        return audioop.add(audioop.tostereo(left, width, 1, 0), audioop.tostereo(right, width, 0, 1), width)
+
+    def ramp(self, fragment: Frames, width: int, start: float, end: float) -> bytes:
+        return _array_dsp.ramp(fragment, width, start, end)
+
+
+class _ArrayDsp:
+    name = "array"
+
+    def __init__(self) -> None:
+        self.typecodes = {1: "b", 2: "h", 4: "i" if array.array("i").itemsize == 4 else "l"}
+
+    def decode(self, frames: Frames, width: int) -> Sequence[int]:
+        if width == 3:
+            frames = bytes(frames)
+            return [int.from_bytes(frames[i:i+3], sys.byteorder, signed=True) for i in range(0, len(frames), 3)]
+        values = array.array(self.typecodes[width])
+        values.frombytes(frames)
+        return values
+
+    def encode(self, values: Iterable[float], width: int, clip: bool=True) -> bytes:
+        if clip:
+            low, high = _limits(width)
+            values = [low if v < low else high if v > high else int(v) for v in values]
+        if width == 3:
+            return b"".join(v.to_bytes(3, sys.byteorder, signed=True) for v in values)   # type: ignore
+        return array.array(self.typecodes[width], values).tobytes()   # type: ignore
+
+    def add(self, fragment1: Frames, fragment2: Frames, width: int) -> bytes:
+        return self.encode(map(int.__add__, self.decode(fragment1, width), self.decode(fragment2, width)), width)
+
+    def mix(self, fragments: Sequence[Frames], width: int) -> bytes:
+        accumulator = list(self.decode(fragments[0], width))
+        for fragment in fragments[1:]:
+            accumulator = list(map(int.__add__, accumulator, self.decode(fragment, width)))
+        return self.encode(accumulator, width)
+
+    def mul(self, fragment: Frames, width: int, factor: float) -> bytes:
+        return self.encode((math.floor(v * factor) for v in self.decode(fragment, width)), width)
+
+    def bias(self, fragment: Frames, width: int, bias: int) -> bytes:
+        low, high = _limits(width)
+        return self.encode([(v + bias - low) % (high - low + 1) + low for v in self.decode(fragment, width)], width, False)
+
+    def tostereo(self, fragment: Frames, width: int, lfactor: float, rfactor: float) -> bytes:
+        stereo = []     # type: List[float]
+        for v in self.decode(fragment, width):
+            stereo.append(math.floor(v * lfactor))
+            stereo.append(math.floor(v * rfactor))
+        return self.encode(stereo, width)
+
+    def tomono(self, fragment: Frames, width: int, lfactor: float, rfactor: float) -> bytes:
+        values = self.decode(fragment, width)
+        return self.encode((math.floor(left * lfactor + right * rfactor) for left, right in zip(values[0::2], values[1::2])), width)
+
+    def interleave(self, left: Frames, right: Frames, width: int) -> bytes:
+        stereo = []     # type: List[int]
+        for lr in zip(self.decode(left, width), self.decode(right, width)):
+            stereo.extend(lr)
+        return self.encode(stereo, width, False)
+
+    def ramp(self, fragment: Frames, width: int, start: float, end: float) -> bytes:
+        values = self.decode(fragment, width)
+        step = (end - start) / max(1, len(values))
+        # gains between 0 and 1 can't overflow, so clipping isn't needed
+        clip = max(abs(start), abs(end)) > 1.0
+        return self.encode([int(v * (start + i * step)) for i, v in enumerate(values)], width, clip)
+
+    def lin2lin(self, fragment: Frames, width: int, newwidth: int) -> bytes:
+        if newwidth > width:
+            shift = 8 * (newwidth - width)
+            return self.encode([v << shift for v in self.decode(fragment, width)], newwidth, False)
+        shift = 8 * (width - newwidth)
+        return self.encode([v >> shift for v in self.decode(fragment, width)], newwidth, False)
+
+    def byteswap(self, fragment: Frames, width: int) -> bytes:
+        fragment = bytes(fragment)
+        return b"".join(fragment[i:i+width][::-1] for i in range(0, len(fragment), width))
+
+    def reverse(self, fragment: Frames, width: int) -> bytes:
+        fragment = bytes(fragment)
+        return b"".join(fragment[i:i+width] for i in range(len(fragment)-width, -1, -width))
+
+    def ratecv(self, fragment: Frames, width: int, nchannels: int, inrate: int, outrate: int,
+               state: Any) -> Tuple[bytes, Any]:
+        values = self.decode(fragment, width)
+        numframes = len(values) // nchannels
+        if not numframes:
+            return b"", state
+        position, previous, step, count = _ratecv_positions(numframes, inrate, outrate, state, list(values[:nchannels]))
+        extended = list(previous) + list(values)
+        result = []     # type: List[float]
+        for i in range(count):
+            frame_position = position + i * step
+            frame = int(frame_position)
+            fraction = frame_position - frame
+            nextframe = min(frame + 1, numframes)
+            for c in range(nchannels):
+                v1 = extended[frame * nchannels + c]
+                v2 = extended[nextframe * nchannels + c]
+                result.append(math.floor(v1 + (v2 - v1) * fraction))
+        return self.encode(result, width), (position + count * step - numframes, list(values[-nchannels:]))
+
+    def peak(self, fragment: Frames, width: int) -> int:
+        return max((abs(v) for v in self.decode(fragment, width)), default=0)
+
+    def rms(self, fragment: Frames, width: int) -> int:
+        values = self.decode(fragment, width)
+        return int(math.sqrt(sum(v * v for v in values) / len(values))) if len(values) else 0
+
+    def getsample(self, fragment: Frames, width: int, index: int) -> int:
+        return self.decode(fragment[index*width: index*width+width], width)[0]
+
+
+class MixBuffer:
+    """
+    A preallocated buffer to mix fragments of sample data into, meant to be reused for every chunk.
+    Fragments shorter than the buffer are mixed in as if they were padded with silence, without copying them.
+    With the numpy backend, mixing doesn't allocate any new buffers: the voices are summed in a preallocated
+    accumulator with enough headroom, and clipped once into the preallocated output buffer.
+    (The other backends still pad into preallocated buffers, but the mixing itself creates a new result.)
+    The result is a view on memory that is reused, so it is only valid until the next mix.
+    A fragment can be mixed in with a gain ramp (made with make_ramp) to fade it in or out.
+    """
+    def __init__(self, size: int, width: int) -> None:
+        self.size = size
+        self.width = width
+        self.voices = 0
+        self.silence = memoryview(bytes(size))
+        self.first = None   # type: Optional[Frames]
+        self.output = bytearray(size)
+        self.output_view = memoryview(self.output)
+        self.low, self.high = _limits(width)
+        self.accumulator = None
+        if backend == "numpy" and width != 3:
+            self.dtype = {1: numpy.int8, 2: numpy.int16, 4: numpy.int32}[width]
+            self.accumulator = numpy.zeros(size // width, dtype=numpy.int32 if width <= 2 else numpy.int64)
+            self.output_array = numpy.frombuffer(self.output, dtype=self.dtype)
+            self.scratch = numpy.zeros(size // width, dtype=numpy.float32)
+        else:
+            self.fragments = []     # type: List[Frames]
+            self.padded = []        # type: List[bytearray]
+
+    def make_ramp(self, fade_length: int, rising: bool) -> Any:
+        """
+        Precomputes a gain ramp that fades in from silence (or fades out to silence) over the first
+        fade_length sample values of a fragment. A fade out stays silent after that.
+        """
+        fade_length = min(max(1, fade_length), self.size // self.width)
+        if self.accumulator is not None:
+            gains = numpy.zeros(self.size // self.width, dtype=numpy.float32)
+            gains[:fade_length] = numpy.linspace(1.0, 0.0, fade_length, endpoint=False)
+            return 1.0 - gains if rising else gains
+        # without numpy only the part that actually fades is processed, the rest is either untouched or silent
+        gains = [1.0 - i / fade_length for i in range(fade_length)]
+        return [1.0 - gain for gain in gains] if rising else gains, rising
+
+    def clear(self) -> None:
+        self.voices = 0
+        self.first = None
+        if self.accumulator is None:
+            self.fragments.clear()
+
+    def add(self, fragment: Frames, ramp: Any=None) -> None:
+        length = len(fragment)
+        if length > self.size:
+            raise ValueError("fragment is larger than the mix buffer")
+        if ramp is not None and self.accumulator is None:
+            gains, rising = ramp
+            fade_bytes = len(gains) * self.width
+            faded = _array_dsp.encode(map(int, map(float.__mul__, gains, _array_dsp.decode(fragment[:fade_bytes], self.width))),
+                                      self.width, False)
+            fragment = faded + bytes(fragment[fade_bytes:]) if rising else faded
+            length = len(fragment)
+        if not self.voices and (ramp is None or self.accumulator is None):
+            self.first = fragment
+        if self.accumulator is not None:
+            values = numpy.frombuffer(fragment, dtype=self.dtype)
+            if ramp is not None:
+                # one vectorized multiply into the preallocated scratch buffer
+                values = numpy.multiply(values, ramp[:len(values)], out=self.scratch[:len(values)])
+            target = self.accumulator if length == self.size else self.accumulator[:len(values)]
+            if self.voices:
+                numpy.add(target, values, out=target, casting="unsafe")
+            else:
+                if length < self.size:
+                    self.accumulator.fill(0)
+                target[:] = values
+        else:
+            if length < self.size:
+                while len(self.padded) <= self.voices:
+                    self.padded.append(bytearray(self.size))
+                padded = self.padded[self.voices]
+                padded[:length] = fragment
+                padded[length:] = self.silence[length:]
+                fragment = padded
+            self.fragments.append(fragment)
+        self.voices += 1
+
+    def result(self) -> memoryview:
+        if self.voices == 1 and self.first is not None and len(self.first) == self.size:
+            return memoryview(self.first)   # nothing to mix
+        if self.voices == 0:
+            return self.silence
+        if self.accumulator is not None:
+            numpy.clip(self.accumulator, self.low, self.high, out=self.accumulator)
+            numpy.copyto(self.output_array, self.accumulator, casting="unsafe")
+            return self.output_view
+        if self.voices == 1:
+            return memoryview(self.fragments[0])
+        self.output_view[:] = mix(self.fragments, self.width)
+        return self.output_view
+
+
+_array_dsp = _ArrayDsp()
+
+
+def _select_backend(name: Optional[str]=None) -> Any:
+    if name == "numpy" or (not name and numpy):
+        return _NumpyDsp()
+    if name == "audioop" or (not name and audioop):
+        return _AudioopDsp()
+    return _ArrayDsp()
+
+
+def use_backend(name: Optional[str]=None) -> None:
+    """Switch to the given backend ('numpy', 'audioop' or 'array'), or the best available one."""
+    global backend, _implementation
+    _implementation = _select_backend(name)
+    backend = _implementation.name
+
+
+def add(fragment1: Frames, fragment2: Frames, width: int) -> bytes:
+    return _implementation.add(fragment1, fragment2, width)
+
+
+def mix(fragments: Sequence[Frames], width: int) -> bytes:
+    """Adds all fragments (of the same length) together, clipping the result once."""
+    return _implementation.mix(fragments, width)
+
+
+def mul(fragment: Frames, width: int, factor: float) -> bytes:
+    return _implementation.mul(fragment, width, factor)
+
+
+def ramp(fragment: Frames, width: int, start: float, end: float) -> bytes:
+    """Multiplies the fragment with a gain that goes linearly from start to end."""
+    return _implementation.ramp(fragment, width, start, end)
+
+
+def bias(fragment: Frames, width: int, bias: int) -> bytes:
+    return _implementation.bias(fragment, width, bias)
+
+
+def tostereo(fragment: Frames, width: int, lfactor: float, rfactor: float) -> bytes:
+    return _implementation.tostereo(fragment, width, lfactor, rfactor)
+
+
+def tomono(fragment: Frames, width: int, lfactor: float, rfactor: float) -> bytes:
+    return _implementation.tomono(fragment, width, lfactor, rfactor)
+
+
+def interleave(left: Frames, right: Frames, width: int) -> bytes:
+    """Makes a stereo fragment out of a left and a right mono fragment."""
+    return _implementation.interleave(left, right, width)
+
+
+def lin2lin(fragment: Frames, width: int, newwidth: int) -> bytes:
+    return _implementation.lin2lin(fragment, width, newwidth)
+
+
+def byteswap(fragment: Frames, width: int) -> bytes:
+    return _implementation.byteswap(fragment, width)
+
+
+def reverse(fragment: Frames, width: int) -> bytes:
+    return _implementation.reverse(fragment, width)
+
+
+def ratecv(fragment: Frames, width: int, nchannels: int, inrate: int, outrate: int, state: Any) -> Tuple[bytes, Any]:
+    """
+    Converts the frame rate. Pass the returned state to the next call to convert a stream in fragments
+    (and None for the first one). The state is specific to the backend.
+    """
+    return _implementation.ratecv(fragment, width, nchannels, inrate, outrate, state)
+
+
+def peak(fragment: Frames, width: int) -> int:
+    """The maximum absolute sample value (audioop.max)."""
+    return _implementation.peak(fragment, width)
+
+
+def rms(fragment: Frames, width: int) -> int:
+    return _implementation.rms(fragment, width)
+
+
+def getsample(fragment: Frames, width: int, index: int) -> int:
+    return _implementation.getsample(fragment, width, index)
+
+
+backend = ""
+_implementation = None     # type: Any
+use_backend()
@@ -11,16 +11,16 @@ loop samples as well without noticable overhead (great for continous effects or
 Written by Irmen de Jong (irmen@razorvine.net) - License: GNU LGPL 3.
 """
 
-import audioop
 import queue
 import threading
 import time
 import io
 import os
 import warnings
-from collections import defaultdict
+import itertools
+from collections import defaultdict, deque
 from typing import Generator, Union, Dict, Tuple, Any, Type, List, Callable, Iterable, Optional
-from .import params
+from .import params, dsp
 from .sample import Sample
 
 
@@ -40,150 +40,255 @@ antipop_fadeout = 0.02
 # or by setting the PY_SYNTHPLAYER_AUDIO_DEVICE environment variable.
 default_audio_device = -1
 
+# name of the audio api class to try first (for instance remembered from an earlier run), instead of the default order.
+preferred_api = ""
+
 
 class RealTimeMixer:
     """
     Real-time audio sample mixer. Samples are played as soon as they're added into the mix.
     Simply adds a number of samples, clipping if values become too large.
     Produces (via a generator method) chunks of audio stream data to be fed to the sound output stream.
+
+    Adding and stopping samples doesn't touch the mixer's state directly: it puts a command
+    in a queue that the mixer processes at the start of every chunk. The active samples are only
+    ever touched by the mixer itself, so no locks are needed: the thread that plays samples never
+    has to wait for the audio output, and the audio output never has to wait for that thread.
     """
     def __init__(self, chunksize: int, all_played_callback: Callable=None, pop_prevention: Optional[bool]=None) -> None:
         self.chunksize = chunksize
         self.all_played_callback = all_played_callback or (lambda: None)
-        self.add_lock = threading.Lock()
         self.chunks_mixed = 0
+        self.last_mix_duration = 0.0    # seconds spent mixing the last chunk
+        self.last_mix_voices = 0        # number of samples mixed into the last chunk
+        self.chunk_mixed_callback = None    # type: Optional[Callable[[float, float], None]]
         if pop_prevention is None:
             self.pop_prevention = params.auto_sample_pop_prevention
         else:
             self.pop_prevention = pop_prevention
-        self._sid = 0
+        self._sids = itertools.count(1)
         self._closed = False
+        self._running = False   # is the chunks generator active
+        # appending and popping on a deque are atomic, so it is safe to use as a queue between two threads
+        self.commands = deque()     # type: deque[Tuple[Any, ...]]
+        self._batches = threading.local()   # the batch being collected is per thread, see begin_batch
         self.active_samples = {}   # type: Dict[int, Tuple[str, float, Generator[memoryview, None, None]]]
         self.sample_counts = defaultdict(int)  # type: Dict[str, int]
         self.sample_limits = defaultdict(lambda: 9999999)  # type: Dict[str, int]
-
-    @staticmethod
-    def antipop_fadein_fadeout(orig_generator):
-        # very quickly fades in the first chunk,and fades out the last chunk,
-        # to avoid clicks/pops when the sound suddenly starts playing or is stopped.
-        chunk = next(orig_generator)
-        sample = Sample.from_raw_frames(chunk,
-                                        params.norm_samplewidth,
-                                        params.norm_samplerate,
-                                        params.norm_nchannels)
-        sample.fadein(antipop_fadein)
-        fadeout = yield sample.view_frame_data()
-        while not fadeout:
-            try:
-                fadeout = yield next(orig_generator)
-            except StopIteration:
-                return
-        chunk = next(orig_generator)
-        yield chunk  # to satisfy the result for the .send() on this generator
-        sample = Sample.from_raw_frames(chunk,
-                                        params.norm_samplewidth,
-                                        params.norm_samplerate,
-                                        params.norm_nchannels)
-        sample.fadeout(antipop_fadeout)
-        yield sample.view_frame_data()  # the actual last chunk, faded out
+        self.max_voices = 0         # global voice budget, 0 means unlimited
+        self.sample_priorities = {}     # type: Dict[str, int]
+        self.voices_stolen = self.voices_rejected = 0
+        self._finished = []     # type: List[int]
+        self._fading_in = set()     # type: set[int]
+        self._fading_out = set()    # type: set[int]
 
     def add_sample(self, sample: Sample, repeat: bool=False, chunk_delay: int=0, sid: int=None) -> Union[int, None]:
-        if not self.allow_sample(sample, repeat):
-            return None
-        with self.add_lock:
-            sample_chunks = sample.chunked_frame_data(chunksize=self.chunksize, repeat=repeat)
-            if self.pop_prevention:
-                sample_chunks = self.antipop_fadein_fadeout(sample_chunks)
-            self._sid += 1
-            sid = sid or self._sid
-            self.active_samples[sid] = (sample.name, self.chunks_mixed+chunk_delay, sample_chunks)
-            self.sample_counts[sample.name] += 1
-            return sid
+        """
+        Queues the sample to be mixed in, and returns the sid it will have.
+        The play limits and the voice budget are only checked by the mixer, when it executes the command:
+        a stop that is still queued before it (for instance to restart a sound) may make room for it.
+        So the sid is tentative: the mixer may still reject the sample, and then there never is a voice
+        with that sid. Stopping it is harmless (it does nothing), but don't count on it being played.
+        To stop or replace a sound, address it by its name instead.
+        """
+        sample_chunks = sample.chunked_frame_data(chunksize=self.chunksize, repeat=repeat)
+        sid = sid or next(self._sids)
+        self._command(("add", sid, sample.name, repeat, chunk_delay, sample_chunks))
+        return sid
 
     def allow_sample(self, sample: Sample, repeat: bool=False) -> bool:
-        if repeat and self.sample_counts[sample.name] >= 1:  # don't allow more than one repeating sample
+        return self._allow(sample.name, repeat)
+
+    def _allow(self, name: str, repeat: bool) -> bool:
+        # (uses get, because the defaultdicts must not be modified from outside the mixer)
+        # voices that are fading out after a stop don't count, they've already been released
+        count = self.sample_counts.get(name, 0)
+        if repeat and count >= 1:  # don't allow more than one repeating sample
             return False
-        if not sample.name:
+        if not name:
             return True     # samples without a name can't be checked
-        return self.sample_counts[sample.name] < self.sample_limits[sample.name]
-
-    def determine_samples_to_mix(self) -> List[Tuple[int, Tuple[str, Generator[memoryview, None, None]]]]:
-        active = []
-        with self.add_lock:
-            for sid, (name, play_at_chunk, sample) in self.active_samples.items():
-                if play_at_chunk <= self.chunks_mixed:
-                    active.append((sid, (name, sample)))
-        return active
+        return count < self.sample_limits.get(name, 9999999)
 
     def clear_sources(self) -> None:
         # clears all sources
-        with self.add_lock:
-            self.active_samples.clear()
-            self.sample_counts.clear()
-            self.all_played_callback()
+        self._command(("clear",))
 
     def clear_source(self, sid_or_name: Union[int, str]) -> None:
         # clear a single sample source by its sid or all sources with the sample name
-        if isinstance(sid_or_name, int):
-            self.remove_sample(sid_or_name)
+        self._command(("stop", sid_or_name))
+
+    def begin_batch(self) -> None:
+        """
+        From now on, the samples added and stopped by this thread are collected and only passed to the mixer
+        at end_batch(), as a single command. So they're guaranteed to start (or stop) in the same chunk.
+        Other threads are not affected: their commands still go to the mixer directly.
+        """
+        self._batches.batch = []
+
+    def end_batch(self) -> None:
+        batch = getattr(self._batches, "batch", None)
+        self._batches.batch = None
+        if batch:
+            self.commands.append(("batch", batch))
+
+    def _command(self, command: Tuple[Any, ...]) -> None:
+        batch = getattr(self._batches, "batch", None)
+        if batch is not None:
+            batch.append(command)
         else:
-            active_samples = self.determine_samples_to_mix()
-            for sid, (name, _) in active_samples:
-                if name == sid_or_name:
+            self.commands.append(command)
+
+    def process_commands(self) -> None:
+        # called by the mixer (only!) at the start of every chunk
+        commands = self.commands
+        while commands:
+            command = commands.popleft()
+            if command[0] == "batch":
+                for batched_command in command[1]:
+                    self._execute(batched_command)
+            else:
+                self._execute(command)
+
+    def _execute(self, command: Tuple[Any, ...]) -> None:
+        if command[0] == "add":
+            _, sid, name, repeat, chunk_delay, sample_chunks = command
+            if self._allow(name, repeat) and self._make_room(name):
+                self.active_samples[sid] = (name, self.chunks_mixed + chunk_delay, sample_chunks)
+                self.sample_counts[name] += 1
+                if self.pop_prevention:
+                    self._fading_in.add(sid)
+        elif command[0] == "stop":
+            sid_or_name = command[1]
+            if isinstance(sid_or_name, int):
+                self.remove_sample(sid_or_name)
+            else:
+                for sid in [sid for sid, (name, _, _) in self.active_samples.items() if name == sid_or_name]:
                     self.remove_sample(sid)
+        elif command[0] == "clear":
+            self.active_samples.clear()
+            self.sample_counts.clear()
+            self._fading_in.clear()
+            self._fading_out.clear()
+            self.all_played_callback()
+
+    def _make_room(self, name: str) -> bool:
+        # When the voice budget is used up, the voice with the lowest priority is stolen (the oldest one, if there
+        # are several) to make room for the new sample. Voices with a higher priority than the new sample are never
+        # stolen; if there are only those, the new sample isn't played.
+        # Voices that are fading out, or that are still waiting for their delay, don't count against the budget.
+        if not self.max_voices or len(self.active_samples) < self.max_voices:
+            return True
+        voices = [(sid, voice_name) for sid, (voice_name, play_at_chunk, _) in self.active_samples.items()
+                  if play_at_chunk <= self.chunks_mixed and sid not in self._fading_out]
+        if len(voices) < self.max_voices:
+            return True
+        priority = self.sample_priorities.get(name, 0)
+        victim = None
+        victim_priority = priority
+        for sid, voice_name in voices:     # in the order they were added, oldest first
+            voice_priority = self.sample_priorities.get(voice_name, 0)
+            if voice_priority < victim_priority or (victim is None and voice_priority <= priority):
+                victim, victim_priority = sid, voice_priority
+        if victim is None:
+            self.voices_rejected += 1
+            return False
+        self.remove_sample(victim)      # (faded out, if pop prevention is on)
+        self.voices_stolen += 1
+        return True
 
     def chunks(self) -> Generator[memoryview, None, None]:
-        silence = b"\0" * self.chunksize
-        while not self._closed:
-            chunks_to_mix = []
-            active_samples = self.determine_samples_to_mix()
-            for i, (name, s) in active_samples:
-                try:
-                    chunk = next(s)
-                    if len(chunk) > self.chunksize:
-                        raise ValueError("chunk from sample is larger than chunksize from mixer")
-                    if len(chunk) < self.chunksize:
-                        # pad the chunk with some silence
-                        chunk = memoryview(chunk.tobytes() + silence[len(chunk):])
-                    chunks_to_mix.append(chunk)
-                except StopIteration:
-                    self.remove_sample(i, True)
-            chunks_to_mix = chunks_to_mix or [silence]      # type: ignore
-            assert all(len(c) == self.chunksize for c in chunks_to_mix)
-            mixed = chunks_to_mix[0]
-            if len(chunks_to_mix) > 1:
-                for to_mix in chunks_to_mix[1:]:
-                    mixed = audioop.add(mixed, to_mix, params.norm_nchannels)
-                mixed = memoryview(mixed)
-            self.chunks_mixed += 1
-            yield mixed
+        """
+        Produces the mixed chunks. The mixing is done in a buffer that is reused for every chunk,
+        so a chunk is only valid until the next one is produced (copy it if you need to keep it).
+        """
+        mixbuffer = dsp.MixBuffer(self.chunksize, params.norm_samplewidth)
+        # the anti-pop fades are precomputed gain ramps, that are applied while mixing
+        values_per_second = params.norm_samplerate * params.norm_nchannels
+        fadein_ramp = mixbuffer.make_ramp(int(antipop_fadein * values_per_second), True)
+        fadeout_ramp = mixbuffer.make_ramp(int(antipop_fadeout * values_per_second), False)
+        finished = self._finished
+        fading_in = self._fading_in
+        fading_out = self._fading_out
+        self._running = True
+        try:
+            while True:
+                mix_start = time.perf_counter()
+                self.process_commands()
+                if self._closed:
+                    break   # (after the commands, so the clear queued by close() releases the voices)
+                mixbuffer.clear()
+                for sid, (name, play_at_chunk, s) in self.active_samples.items():
+                    if play_at_chunk > self.chunks_mixed:
+                        continue
+                    try:
+                        chunk = next(s)
+                        if len(chunk) > self.chunksize:
+                            raise ValueError("chunk from sample is larger than chunksize from mixer")
+                        if fading_out and sid in fading_out:
+                            mixbuffer.add(chunk, fadeout_ramp)
+                            finished.append(sid)
+                        elif fading_in and sid in fading_in:
+                            mixbuffer.add(chunk, fadein_ramp)
+                            fading_in.discard(sid)
+                        else:
+                            mixbuffer.add(chunk)     # shorter chunks are padded with silence
+                    except StopIteration:
+                        finished.append(sid)
+                if finished:
+                    for sid in finished:
+                        self.remove_sample(sid, True)
+                    finished.clear()
+                self.last_mix_voices = mixbuffer.voices
+                mixed = mixbuffer.result()
+                self.chunks_mixed += 1
+                mix_end = time.perf_counter()
+                self.last_mix_duration = mix_end - mix_start
+                if self.chunk_mixed_callback:
+                    self.chunk_mixed_callback(mix_start, mix_end)
+                yield mixed
+        finally:
+            self.process_commands()     # releases the voices when the generator is closed or stopped
+            self._running = False
 
     def remove_sample(self, sid: int, sample_exhausted: bool=False) -> None:
-        def actually_remove(sid, name):
-            del self.active_samples[sid]
+        # only called by the mixer, other threads use clear_source
+        if sid not in self.active_samples:
+            return
+        if sid in self._fading_out:
+            if not sample_exhausted:
+                return      # already stopped
+            released = True
+        else:
+            released = False
+            if self.pop_prevention and not sample_exhausted and sid not in self._fading_in:
+                # The sample is already sounding (it isn't waiting for its first, faded in, chunk).
+                # The next chunk of the sample is faded out, after which it is removed.
+                # It no longer counts for the play limits, so the sample can be restarted right away.
+                self._fading_out.add(sid)
+                self.sample_counts[self.active_samples[sid][0]] -= 1
+                return
+        name = self.active_samples.pop(sid)[0]
+        if not released:
             self.sample_counts[name] -= 1
-            if not self.active_samples:
-                self.all_played_callback()
-        with self.add_lock:
-            if sid in self.active_samples:
-                name, play_at_chunk, generator = self.active_samples[sid]
-                if self.pop_prevention and not sample_exhausted:
-                    # first let the generator produce a fadeout
-                    try:
-                        generator.send("fadeout")       # type: ignore
-                    except (TypeError, ValueError, StopIteration):
-                        # generator couldn't process the fadeout, just remove the sample...
-                        actually_remove(sid, name)
-                else:
-                    # remove a finished sample (or directly, if no pop prevention active)
-                    actually_remove(sid, name)
+        self._fading_in.discard(sid)
+        self._fading_out.discard(sid)
+        if not self.active_samples:
+            self.all_played_callback()
 
     def set_limit(self, samplename: str, max_simultaneously: int) -> None:
         self.sample_limits[samplename] = max_simultaneously
 
+    def set_priority(self, samplename: str, priority: int) -> None:
+        # samples with a low priority are the first to be stopped when the voice budget (max_voices) is used up
+        self.sample_priorities[samplename] = priority
+
     def close(self) -> None:
+        # The mixer thread executes the queued clear at its next chunk, and then stops.
+        # If it's not running (anymore), the voices are released here.
         self.clear_sources()
         self._closed = True
+        if not self._running:
+            self.process_commands()
 
 
 class AudioApi:
@@ -266,6 +371,7 @@ def best_api(samplerate: int=0, samplewidth: int=0, nchannels: int=0,
         candidates = [Sounddevice_Mix, SounddeviceThread_Mix, PyAudio_Mix]
     else:
         candidates = [SounddeviceThread_Seq, PyAudio_Seq, Winsound_Seq]
+    candidates.sort(key=lambda api: api.__name__ != preferred_api)
     for candidate in candidates:
         try:
             if mixing == "mix":
@@ -415,7 +521,7 @@ class SounddeviceThread_Mix(AudioApi, SounddeviceUtils):
                     if len(data) < self.chunksize:
                         self.stream.write(silence[len(data):])
                     if self.playing_callback:
-                        sample = Sample.from_raw_frames(data, self.samplewidth, self.samplerate, self.nchannels)
+                        sample = Sample.from_raw_frames(bytes(data), self.samplewidth, self.samplerate, self.nchannels)
                         self.playing_callback(sample)
             except StopIteration:
                 pass
@@ -853,7 +959,8 @@ class Output:
         time.sleep(0.1)     # allow the mixer thread/stream to warm up (if any)
 
     def play_sample(self, sample: Sample, repeat: bool=False, delay=0.0) -> int:
-        """Play a single sample (asynchronously)."""
+        """Play a single sample (asynchronously).
+        The returned sample id is tentative: the mixer may still reject the sample when it gets to it."""
         assert sample.samplewidth == self.samplewidth
         assert sample.samplerate == self.samplerate
         assert sample.nchannels == self.nchannels
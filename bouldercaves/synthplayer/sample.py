@@ -7,12 +7,11 @@ Written by Irmen de Jong (irmen@razorvine.net) - License: GNU LGPL 3.
 
 import sys
 import wave
-import audioop
 import array
 import math
 import itertools
 from typing import Callable, Generator, Iterable, Any, Tuple, Union, Optional, BinaryIO
-from . import params
+from . import params, dsp
 try:
     import numpy
 except ImportError:
@@ -90,6 +89,16 @@ class Sample:
         s.__nchannels = int(numchannels)
         return s
 
+    @classmethod
+    def from_frame_view(cls, frames: memoryview, samplewidth: int, samplerate: int, numchannels: int, name: str="") -> 'Sample':
+        """
+        Creates a new sample that uses the given memoryview directly as its frame data, without copying it
+        (for instance a slice of a memory mapped file). The sample is locked because the data is shared.
+        """
+        s = cls.from_raw_frames(b"", samplewidth, samplerate, numchannels, name)
+        s.__frames = frames     # type: ignore
+        return s.lock()
+
     @classmethod
     def from_array(cls, array_or_list, samplerate: int, numchannels: int, name: str="") -> 'Sample':
         assert 1 <= numchannels <= 2
@@ -111,7 +120,7 @@ class Sample:
         assert 2 <= samplewidth <= 4
         frames = array_or_list.tobytes()
         if sys.byteorder == "big":
-            frames = audioop.byteswap(frames, samplewidth)
+            frames = dsp.byteswap(frames, samplewidth)
         return Sample.from_raw_frames(frames, samplewidth, samplerate, numchannels, name=name)
 
     @property
@@ -142,11 +151,11 @@ class Sample:
 
     @property
     def maximum(self) -> int:
-        return audioop.max(self.__frames, self.samplewidth)
+        return dsp.peak(self.__frames, self.samplewidth)
 
     @property
     def rms(self) -> float:
-        return audioop.rms(self.__frames, self.samplewidth)
+        return dsp.rms(self.__frames, self.samplewidth)
 
     @property
     def level_db_peak(self) -> Tuple[float, float]:
@@ -167,18 +176,18 @@ class Sample:
         maxvalue = 2**(8*self.__samplewidth-1)
         if self.nchannels == 1:
             if rms_mode:
-                peak_left = peak_right = (audioop.rms(self.__frames, self.__samplewidth)+1)/maxvalue
+                peak_left = peak_right = (dsp.rms(self.__frames, self.__samplewidth)+1)/maxvalue
             else:
-                peak_left = peak_right = (audioop.max(self.__frames, self.__samplewidth)+1)/maxvalue
+                peak_left = peak_right = (dsp.peak(self.__frames, self.__samplewidth)+1)/maxvalue
         else:
-            left_frames = audioop.tomono(self.__frames, self.__samplewidth, 1, 0)
-            right_frames = audioop.tomono(self.__frames, self.__samplewidth, 0, 1)
+            left_frames = dsp.tomono(self.__frames, self.__samplewidth, 1, 0)
+            right_frames = dsp.tomono(self.__frames, self.__samplewidth, 0, 1)
             if rms_mode:
-                peak_left = (audioop.rms(left_frames, self.__samplewidth)+1)/maxvalue
-                peak_right = (audioop.rms(right_frames, self.__samplewidth)+1)/maxvalue
+                peak_left = (dsp.rms(left_frames, self.__samplewidth)+1)/maxvalue
+                peak_right = (dsp.rms(right_frames, self.__samplewidth)+1)/maxvalue
             else:
-                peak_left = (audioop.max(left_frames, self.__samplewidth)+1)/maxvalue
-                peak_right = (audioop.max(right_frames, self.__samplewidth)+1)/maxvalue
+                peak_left = (dsp.peak(left_frames, self.__samplewidth)+1)/maxvalue
+                peak_right = (dsp.peak(right_frames, self.__samplewidth)+1)/maxvalue
         # cut off at the bottom at -60 instead of all the way down to -infinity
         return max(20.0*math.log(peak_left, 10), -60.0), max(20.0*math.log(peak_right, 10), -60.0)
 
@@ -200,15 +209,17 @@ class Sample:
         """
         if repeat:
             # continuously repeated
-            bdata = self.__frames
-            if len(bdata) < chunksize:
-                bdata = bdata * int(math.ceil(chunksize / len(bdata)))
-            length = len(bdata)
-            bdata += bdata[:chunksize]
-            mdata = memoryview(bdata)
+            mdata = memoryview(self.__frames)
+            if len(mdata) < chunksize:
+                mdata = memoryview(bytes(mdata) * int(math.ceil(chunksize / len(mdata))))
+            length = len(mdata)
             i = 0
             while not stopcondition():
-                yield mdata[i: i + chunksize]
+                if i + chunksize <= length:
+                    yield mdata[i: i + chunksize]
+                else:
+                    # stitch the end and the start of the sample together (the frame data itself is not copied)
+                    yield memoryview(bytes(mdata[i:]) + bytes(mdata[:i + chunksize - length]))
                 i = (i + chunksize) % length
         else:
             # one-shot
@@ -322,11 +333,11 @@ class Sample:
         self.resample(params.norm_samplerate)
         if self.samplewidth != params.norm_samplewidth:
             # Convert to 16 bit sample size.
-            self.__frames = audioop.lin2lin(self.__frames, self.samplewidth, params.norm_samplewidth)
+            self.__frames = dsp.lin2lin(self.__frames, self.samplewidth, params.norm_samplewidth)
             self.__samplewidth = params.norm_samplewidth
         if self.nchannels == 1:
             # convert to stereo
-            self.__frames = audioop.tostereo(self.__frames, self.samplewidth, 1, 1)
+            self.__frames = dsp.tostereo(self.__frames, self.samplewidth, 1, 1)
             self.__nchannels = 2
         return self
 
@@ -339,7 +350,7 @@ class Sample:
             raise RuntimeError("cannot modify a locked sample")
         if samplerate == self.__samplerate:
             return self
-        self.__frames = audioop.ratecv(self.__frames, self.samplewidth, self.nchannels, self.samplerate, samplerate, None)[0]
+        self.__frames = dsp.ratecv(self.__frames, self.samplewidth, self.nchannels, self.samplerate, samplerate, None)[0]
         self.__samplerate = samplerate
         return self
 
@@ -355,7 +366,7 @@ class Sample:
         if speed == 1.0:
             return self
         rate = self.samplerate
-        self.__frames = audioop.ratecv(self.__frames, self.samplewidth, self.nchannels, int(self.samplerate*speed), rate, None)[0]
+        self.__frames = dsp.ratecv(self.__frames, self.samplewidth, self.nchannels, int(self.samplerate*speed), rate, None)[0]
         self.__samplerate = rate
         return self
 
@@ -376,11 +387,11 @@ class Sample:
         """Returns the raw sample frames scaled to 32 bits. See make_32bit method for more info."""
         if self.samplewidth == 4:
             return self.__frames
-        frames = audioop.lin2lin(self.__frames, self.samplewidth, 4)
+        frames = dsp.lin2lin(self.__frames, self.samplewidth, 4)
         if not scale_amplitude:
             # we need to scale back the sample amplitude to fit back into 24/16/8 bit range
             factor = 1.0/2**(8*abs(self.samplewidth-4))
-            frames = audioop.mul(frames, 4, factor)
+            frames = dsp.mul(frames, 4, factor)
         return frames
 
     def make_16bit(self, maximize_amplitude: bool=True) -> 'Sample':
@@ -395,7 +406,7 @@ class Sample:
         if maximize_amplitude:
             self.amplify_max()
         if self.samplewidth > 2:
-            self.__frames = audioop.lin2lin(self.__frames, self.samplewidth, 2)
+            self.__frames = dsp.lin2lin(self.__frames, self.samplewidth, 2)
             self.__samplewidth = 2
         return self
 
@@ -403,18 +414,18 @@ class Sample:
         """Amplify the sample to maximum volume without clipping or overflow happening."""
         if self.__locked:
             raise RuntimeError("cannot modify a locked sample")
-        max_amp = audioop.max(self.__frames, self.samplewidth)
+        max_amp = dsp.peak(self.__frames, self.samplewidth)
         max_target = 2 ** (8 * self.samplewidth - 1) - 2
         if max_amp > 0:
             factor = max_target/max_amp
-            self.__frames = audioop.mul(self.__frames, self.samplewidth, factor)
+            self.__frames = dsp.mul(self.__frames, self.samplewidth, factor)
         return self
 
     def amplify(self, factor: float) -> 'Sample':
         """Amplifies (multiplies) the sample by the given factor. May cause clipping/overflow if factor is too large."""
         if self.__locked:
             raise RuntimeError("cannot modify a locked sample")
-        self.__frames = audioop.mul(self.__frames, self.samplewidth, factor)
+        self.__frames = dsp.mul(self.__frames, self.samplewidth, factor)
         return self
 
     def at_volume(self, volume: float) -> 'Sample':
@@ -481,14 +492,7 @@ class Sample:
         i = self.frame_idx(self.duration-seconds)
         begin = self.__frames[:i]
         end = self.__frames[i:]  # we fade this chunk
-        numsamples = len(end)/self.__samplewidth
-        decrease = 1.0-target_volume
-        _sw = self.__samplewidth     # optimization
-        _getsample = audioop.getsample   # optimization
-        faded = Sample.get_array(_sw, [int(_getsample(end, _sw, i)*(1.0-i*decrease/numsamples)) for i in range(int(numsamples))])
-        end = faded.tobytes()
-        if sys.byteorder == "big":
-            end = audioop.byteswap(end, self.__samplewidth)
+        end = dsp.ramp(end, self.__samplewidth, 1.0, target_volume)
         self.__frames = begin + end
         return self
 
@@ -502,15 +506,7 @@ class Sample:
         i = self.frame_idx(seconds)
         begin = self.__frames[:i]  # we fade this chunk
         end = self.__frames[i:]
-        numsamples = len(begin)/self.__samplewidth
-        increase = 1.0-start_volume
-        _sw = self.__samplewidth     # optimization
-        _getsample = audioop.getsample   # optimization
-        _incr = increase/numsamples    # optimization
-        faded = Sample.get_array(_sw, [int(_getsample(begin, _sw, i)*(i*_incr+start_volume)) for i in range(int(numsamples))])
-        begin = faded.tobytes()
-        if sys.byteorder == "big":
-            begin = audioop.byteswap(begin, self.__samplewidth)
+        begin = dsp.ramp(begin, self.__samplewidth, start_volume, 1.0)
         self.__frames = begin + end
         return self
 
@@ -536,14 +532,14 @@ class Sample:
             frames[i] = int(frames[i] * next(modulator))
         self.__frames = frames.tobytes()
         if sys.byteorder == "big":
-            self.__frames = audioop.byteswap(self.__frames, self.__samplewidth)
+            self.__frames = dsp.byteswap(self.__frames, self.__samplewidth)
         return self
 
     def reverse(self) -> 'Sample':
         """Reverse the sound."""
         if self.__locked:
             raise RuntimeError("cannot modify a locked sample")
-        self.__frames = audioop.reverse(self.__frames, self.__samplewidth)
+        self.__frames = dsp.reverse(self.__frames, self.__samplewidth)
         return self
 
     def invert(self) -> 'Sample':
@@ -583,7 +579,7 @@ class Sample:
         """Add a bias constant to each sample value."""
         if self.__locked:
             raise RuntimeError("cannot modify a locked sample")
-        self.__frames = audioop.bias(self.__frames, self.__samplewidth, bias)
+        self.__frames = dsp.bias(self.__frames, self.__samplewidth, bias)
         return self
 
     def mono(self, left_factor: float=1.0, right_factor: float=1.0) -> 'Sample':
@@ -593,7 +589,7 @@ class Sample:
         if self.__nchannels == 1:
             return self
         if self.__nchannels == 2:
-            self.__frames = audioop.tomono(self.__frames, self.__samplewidth, left_factor, right_factor)
+            self.__frames = dsp.tomono(self.__frames, self.__samplewidth, left_factor, right_factor)
             self.__nchannels = 1
             return self
         raise ValueError("sample must be stereo or mono already")
@@ -627,7 +623,7 @@ class Sample:
             self.left().amplify(left_factor)
             return self.stereo_mix(right, 'R', right_factor)
         if self.__nchannels == 1:
-            self.__frames = audioop.tostereo(self.__frames, self.__samplewidth, left_factor, right_factor)
+            self.__frames = dsp.tostereo(self.__frames, self.__samplewidth, left_factor, right_factor)
             self.__nchannels = 2
             return self
         raise ValueError("sample must be mono or stereo already")
@@ -755,7 +751,7 @@ class Sample:
                 frames1 += b"\0"*(len(frames2)-len(frames1))
             elif len(frames2) < len(frames1):
                 frames2 += b"\0"*(len(frames1)-len(frames2))
-        self.__frames = audioop.add(frames1, frames2, self.samplewidth)
+        self.__frames = dsp.add(frames1, frames2, self.samplewidth)
         return self
 
     def mix_at(self, seconds: float, other: 'Sample', other_seconds: Optional[float]=None) -> 'Sample':
@@ -775,10 +771,10 @@ class Sample:
             other_frames = other.__frames[:other.frame_idx(other_seconds)]
         else:
             other_frames = other.__frames
-        # Mix the frames. Unfortunately audioop requires splitting and copying the sample data, which is slow.
+        # Mix the frames. Unfortunately this requires splitting and copying the sample data, which is slow.
         pre, to_mix, post = self._mix_split_frames(len(other_frames), start_frame_idx)
         self.__frames = b""  # allow for garbage collection
-        mixed = audioop.add(to_mix, other_frames, self.samplewidth)
+        mixed = dsp.add(to_mix, other_frames, self.samplewidth)
         del to_mix  # more garbage collection
         self.__frames = self._mix_join_frames(pre, mixed, post)
         return self
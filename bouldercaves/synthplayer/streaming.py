@@ -104,6 +104,29 @@ class AudiofileToWavStream(io.RawIOBase):
                 self.sampleformat_options = ["-acodec", codec]
         self.start_stream()
 
+    @classmethod
+    def decode_bytes(cls, data: bytes, samplerate: int=0, channels: int=0, sampleformat: str="") -> bytes:
+        """
+        Decodes the audio file data in memory to WAV PCM data, without using any files on disk:
+        the data is piped into the decoder's stdin and the wav is read from its stdout.
+        Resampling and downmixing are only possible with ffmpeg (oggdec just decodes the ogg).
+        """
+        if cls.ffmpeg_executable:
+            samplerate = samplerate or params.norm_samplerate
+            channels = channels or params.norm_nchannels
+            sampleformat = sampleformat or str(8*params.norm_samplewidth)
+            codec = {"8": "pcm_u8", "16": "pcm_s16le", "24": "pcm_s24le", "32": "pcm_s32le", "float": "pcm_f32le"}[sampleformat]
+            command = [cls.ffmpeg_executable, "-v", "fatal", "-hide_banner", "-i", "pipe:0",
+                       "-ar", str(samplerate), "-ac", str(channels), "-acodec", codec, "-f", "wav", "pipe:1"]
+        elif cls.oggdec_executable:
+            command = [cls.oggdec_executable, "--quiet", "--output", "-", "-"]
+        else:
+            raise RuntimeError("ffmpeg or oggdec (vorbis-tools) required for sound file decoding/conversion")
+        log.debug("decoding from memory: %s", " ".join(command))
+        # communicate() feeds stdin and drains stdout at the same time, so the pipes can't deadlock
+        result = subprocess.run(command, input=data, stdout=subprocess.PIPE, check=True)
+        return result.stdout
+
     @classmethod
     def supports_hq_resample(cls) -> bool:
         if cls.ffmpeg_executable:
@@ -5,7 +5,6 @@ Written by Irmen de Jong (irmen@razorvine.net) - License: GNU GPL 3.0, see LICEN
 """
 
 import time
-import audioop
 import array
 import random
 import itertools
@@ -13,7 +12,7 @@ import collections.abc
 from typing import Callable, Generator, Iterator
 from .synthplayer.synth import FastTriangle, WhiteNoise, Linear, Triangle, Sine, SquareH, \
     EnvelopeFilter, AmpModulationFilter, MixingFilter
-from .synthplayer import params as synth_params
+from .synthplayer import params as synth_params, dsp
 from .synthplayer.sample import Sample
 from . import audio
 
@@ -48,7 +47,7 @@ def sample_from_osc(osc: Iterator[int], chunksize: int=0) -> Sample:
     # A single oscillator gives one channel and the sound output is in stereo,
     # so we duplicate the mono channel into a stereo sample here.
     mono = monochannel_from_osc(osc, chunksize)
-    stereo = audioop.tostereo(mono, synth_params.norm_samplewidth, 1, 1)
+    stereo = dsp.tostereo(mono, synth_params.norm_samplewidth, 1, 1)
     return Sample.from_raw_frames(stereo, synth_params.norm_samplewidth, synth_params.norm_samplerate, 2)
 
 
@@ -118,10 +117,7 @@ class TitleMusic(Sample):
                         # fill up the sample buffer so we have at least one full chunk
                         sample1 = monochannel_from_osc(f1_i, chunksize=osc_chunksize)
                         sample2 = monochannel_from_osc(f2_i, chunksize=osc_chunksize)
-                        sample1 = audioop.tostereo(sample1, synth_params.norm_samplewidth, 1, 0)
-                        sample2 = audioop.tostereo(sample2, synth_params.norm_samplewidth, 0, 1)
-                        sample1 = audioop.add(sample1, sample2, synth_params.norm_samplewidth)
-                        samplebuffer += sample1
+                        samplebuffer += dsp.interleave(sample1, sample2, synth_params.norm_samplewidth)
                 except NoteFinished:
                     # go to next note
                     break
@@ -10,25 +10,42 @@ License: GNU GPL 3.0, see LICENSE
 import array
 import io
 import pkgutil
-from typing import Tuple, Union, Iterable, Sequence
-from PIL import Image
+from typing import Tuple, Union, Iterable, Iterator, Sequence, List, Dict, Any, TYPE_CHECKING
+import PIL
 from .caves import Palette
+from . import diskcache
+if TYPE_CHECKING:
+    from PIL import Image
+
+
+def _pil_image() -> Any:
+    # PIL.Image is only imported when images actually have to be processed (it's slow to import,
+    # and not needed at all when the sprites come from the disk cache)
+    from PIL import Image
+    return Image
+
+
+pillow_version = getattr(PIL, "__version__", None) or getattr(_pil_image(), "PILLOW_VERSION", "?")
 
 
 class Tilesheet:
     """
     Keeps track of the tiles in a matrix that will be shown on the screen.
     For optimized rendering, it tracks 'dirty' tiles.
+    Dirty tiles are also tracked per row, so that clean rows can be skipped
+    entirely and dirty regions can be obtained as merged rectangles.
     """
     def __init__(self, width: int, height: int, view_width: int, view_height: int) -> None:
         self.tiles = array.array('H', [0] * width * height)
         self.dirty_tiles = bytearray(width * height)
+        self.dirty_rows = bytearray(height)
         self.width = width
         self.height = height
         self.view_width = view_width
         self.view_height = view_height
         self.view_x = 0
         self.view_y = 0
+        self.last_dirty_count = 0   # number of dirty tiles returned by the last call to dirty() or dirty_spans()
 
     def set_view(self, vx: int, vy: int) -> None:
         new_vx = min(max(0, vx), self.width - self.view_width)
@@ -55,20 +72,28 @@ class Tilesheet:
         if tilenum != old_value:
             self.tiles[pos] = tilenum
             self.dirty_tiles[pos] = 1
+            self.dirty_rows[y] = 1
 
     def set_tiles(self, x: int, y: int, tile_or_tiles: Union[int, Iterable[int]]) -> None:
         if x < 0 or x >= self.width or y < 0 or y >= self.height:
             raise ValueError("tile xy out of bounds")
         if isinstance(tile_or_tiles, int):
-            # i = x + self.width * y
-            # ol
             enum_tiles = enumerate([tile_or_tiles], start=x + self.width * y)
         else:
             enum_tiles = enumerate(tile_or_tiles, start=x + self.width * y)
+        tiles = self.tiles
+        dirty_tiles = self.dirty_tiles
+        first_changed = last_changed = -1
         for i, t in enum_tiles:
-            if t != self.tiles[i]:
-                self.tiles[i] = t
-                self.dirty_tiles[i] = 1
+            if t != tiles[i]:
+                tiles[i] = t
+                dirty_tiles[i] = 1
+                if first_changed < 0:
+                    first_changed = i
+                last_changed = i
+        if first_changed >= 0:
+            for row in range(first_changed // self.width, last_changed // self.width + 1):
+                self.dirty_rows[row] = 1
 
     def get_tiles(self, x: int, y: int, width: int, height: int) -> Sequence[Iterable[int]]:
         if x < 0 or x >= self.width or y < 0 or y > self.height:
@@ -82,8 +107,19 @@ class Tilesheet:
         return result
 
     def all_dirty(self) -> None:
-        for i in range(self.width * self.height):
-            self.dirty_tiles[i] = True
+        self.dirty_tiles[:] = b"\x01" * (self.width * self.height)
+        self.dirty_rows[:] = b"\x01" * self.height
+
+    def _view_bounds(self) -> Tuple[int, int, int, int]:
+        # the viewable area including a border of 1 tile to allow smooth scroll into view
+        return (max(self.view_x - 1, 0), max(self.view_y - 1, 0),
+                min(self.view_x + self.view_width + 1, self.width), min(self.view_y + self.view_height + 1, self.height))
+
+    def _row_done(self, y: int) -> None:
+        # the dirty flag of a row stays set as long as it still has dirty tiles outside of the viewport
+        yy = self.width * y
+        if self.dirty_tiles.find(1, yy, yy + self.width) < 0:
+            self.dirty_rows[y] = 0
 
     def dirty(self) -> Sequence[Tuple[int, int]]:
         """
@@ -94,15 +130,65 @@ class Tilesheet:
         """
         tiles = self.tiles
         dirty_tiles = self.dirty_tiles
+        dirty_rows = self.dirty_rows
         diff = []
-        for y in range(max(self.view_y - 1, 0), min(self.view_y + self.view_height + 1, self.height)):
+        x1, y1, x2, y2 = self._view_bounds()
+        for y in range(y1, y2):
+            if not dirty_rows[y]:
+                continue
             yy = self.width * y
-            for x in range(max(self.view_x - 1, 0), min(self.view_x + self.view_width + 1, self.width)):
-                if dirty_tiles[x + yy]:
-                    diff.append((x + yy, tiles[x + yy]))
-                    dirty_tiles[x + yy] = False
+            for i in range(yy + x1, yy + x2):
+                if dirty_tiles[i]:
+                    diff.append((i, tiles[i]))
+                    dirty_tiles[i] = False
+            self._row_done(y)
+        self.last_dirty_count = len(diff)
         return diff
 
+    def dirty_spans(self) -> Sequence[Tuple[int, int, int]]:
+        """
+        Returns the dirty part of the viewable area of the tilesheet as row spans.
+        Every span covers all dirty tiles of one row (and possibly some clean tiles in between).
+        Like dirty(), this resets the dirty-flag of the tiles in the returned spans.
+        Returns a list of (y, x_start, x_end) tuples where x_end is exclusive.
+        """
+        dirty_tiles = self.dirty_tiles
+        dirty_rows = self.dirty_rows
+        spans = []
+        x1, y1, x2, y2 = self._view_bounds()
+        for y in range(y1, y2):
+            if not dirty_rows[y]:
+                continue
+            yy = self.width * y
+            start = dirty_tiles.find(1, yy + x1, yy + x2)
+            if start >= 0:
+                end = dirty_tiles.rfind(1, start, yy + x2) + 1
+                dirty_tiles[start:end] = bytes(end - start)
+                spans.append((y, start - yy, end - yy))
+            self._row_done(y)
+        self.last_dirty_count = sum(x_end - x_start for _, x_start, x_end in spans)
+        return spans
+
+    def dirty_rects(self) -> Sequence[Tuple[int, int, int, int]]:
+        """
+        Returns the dirty part of the viewable area of the tilesheet as rectangles,
+        made by merging the dirty spans of consecutive rows that cover the same columns.
+        Meant for renderers that can update whole regions at once.
+        Like dirty(), this resets the dirty-flag of the tiles in the returned rectangles.
+        Returns a list of (x, y, width, height) tuples, in tiles.
+        """
+        rects = []   # type: List[List[int]]
+        open_rects = {}   # type: Dict[Tuple[int, int], List[int]]
+        for y, x_start, x_end in self.dirty_spans():
+            rect = open_rects.get((x_start, x_end))
+            if rect and rect[1] + rect[3] == y:
+                rect[3] += 1
+            else:
+                rect = [x_start, y, x_end - x_start, 1]
+                rects.append(rect)
+                open_rects[(x_start, x_end)] = rect
+        return [tuple(rect) for rect in rects]      # type: ignore
+
 
 # note: everything below assumes that the sprite graphics are 16*16 for one tile!
 
@@ -118,64 +204,170 @@ def text2tiles(text: str) -> Sequence[int]:
     return [num_sprites + ord(c) for c in text]
 
 
-def load_sprites(c64colorpalette: Palette=None, scale: float=1.0, alt_c64tileset=False) -> Sequence[bytes]:
+# the colors in the C-64 tile set images that are replaced by the colors of the cave's palette
+c64_key_colors = (
+    (255, 0, 0),        # red, foreground 1
+    (255, 0, 255),      # purple, foreground 2
+    (255, 255, 0),      # yellow, foreground 3 (highlight)
+    (0, 255, 0),        # green, amoeba color
+    (0, 0, 255),        # blue, slime color
+    (0, 0, 0)           # black, background color
+)
+
+
+def load_sprites(c64colorpalette: Palette=None, scale: float=1.0, alt_c64tileset=False, use_cache: bool=True) -> Sequence[bytes]:
     if c64colorpalette:
-        tiles_filename = "c64_gfx_alt.png" if alt_c64tileset else "c64_gfx.png"
-    else:
-        tiles_filename = "boulder_rush.png"
-    sprite_src_images = []
-    with Image.open(io.BytesIO(pkgutil.get_data(__name__, "gfx/" + tiles_filename) or b"")) as tile_image:
-        if c64colorpalette:
+        return recolor_sprites(load_indexed_sprites(scale, alt_c64tileset, use_cache), c64colorpalette)
+    tiles_data = pkgutil.get_data(__name__, "gfx/boulder_rush.png") or b""
+    if not use_cache:
+        return _load_sprites(tiles_data, False, scale)
+    key = diskcache.make_key("boulder_rush.png", tiles_data, scale, pillow_version)
+    return diskcache.cached("sprites", key, lambda: _load_sprites(tiles_data, False, scale))
+
+
+def load_indexed_sprites(scale: float=1.0, alt_c64tileset=False, use_cache: bool=True) -> Sequence[bytes]:
+    """
+    Loads the C-64 sprites in their original key colors, ready to be recolored via recolor_sprites().
+    Because only the GIF color tables differ between palettes, the sprites are processed only once per scale.
+    """
+    tiles_filename = "c64_gfx_alt.png" if alt_c64tileset else "c64_gfx.png"
+    tiles_data = pkgutil.get_data(__name__, "gfx/" + tiles_filename) or b""
+    if not use_cache:
+        return _load_sprites(tiles_data, True, scale)
+    key = diskcache.make_key(tiles_filename, tiles_data, "indexed", scale, pillow_version)
+    return diskcache.cached("sprites", key, lambda: _load_sprites(tiles_data, True, scale))
+
+
+def recolor_sprites(indexed_images: Sequence[bytes], c64colorpalette: Palette) -> Sequence[bytes]:
+    """Applies the palette to the key-colored sprites, by patching the color table of the GIF images."""
+    new_colors = [c64colorpalette.rgb_fg1, c64colorpalette.rgb_fg2, c64colorpalette.rgb_fg3,
+                  c64colorpalette.rgb_amoeba, c64colorpalette.rgb_slime, c64colorpalette.rgb_screen]
+    color_map = {bytes(key_color): rgb.to_bytes(3, "big") for key_color, rgb in zip(c64_key_colors, new_colors)}
+    return [_recolor_gif(image, color_map) for image in indexed_images]
+
+
+def _recolor_gif(image: bytes, color_map: Dict[bytes, bytes]) -> bytes:
+    # the global color table follows the 6 byte signature and 7 byte logical screen descriptor
+    flags = image[10]
+    if not flags & 0x80:
+        raise ValueError("gif image has no global color table")
+    table_end = 13 + 3 * 2 ** ((flags & 7) + 1)
+    colors = [image[i:i + 3] for i in range(13, table_end, 3)]
+    return image[:13] + b"".join(color_map.get(color, color) for color in colors) + image[table_end:]
+
+
+def load_sprite_atlas(c64colorpalette: Palette=None, scale: float=1.0, alt_c64tileset=False, use_cache: bool=True) -> bytes:
+    """
+    Loads all sprites as a single scaled atlas image (8 sprites per row),
+    to slice the individual tiles from via atlas_tile_box().
+    """
+    if c64colorpalette:
+        return recolor_sprite_atlas(load_indexed_sprite_atlas(scale, alt_c64tileset, use_cache), c64colorpalette)
+    tiles_data = pkgutil.get_data(__name__, "gfx/boulder_rush.png") or b""
+    if not use_cache:
+        return _load_sprite_atlas(tiles_data, False, scale)
+    key = diskcache.make_key("boulder_rush.png", tiles_data, scale, pillow_version)
+    return diskcache.cached("sprite_atlas", key, lambda: [_load_sprite_atlas(tiles_data, False, scale)])[0]
+
+
+def load_indexed_sprite_atlas(scale: float=1.0, alt_c64tileset=False, use_cache: bool=True) -> bytes:
+    """Loads the C-64 sprites atlas in the original key colors, ready to be recolored via recolor_sprite_atlas()."""
+    tiles_filename = "c64_gfx_alt.png" if alt_c64tileset else "c64_gfx.png"
+    tiles_data = pkgutil.get_data(__name__, "gfx/" + tiles_filename) or b""
+    if not use_cache:
+        return _load_sprite_atlas(tiles_data, True, scale)
+    key = diskcache.make_key(tiles_filename, tiles_data, "indexed", scale, pillow_version)
+    return diskcache.cached("sprite_atlas", key, lambda: [_load_sprite_atlas(tiles_data, True, scale)])[0]
+
+
+def recolor_sprite_atlas(indexed_atlas: bytes, c64colorpalette: Palette) -> bytes:
+    return recolor_sprites([indexed_atlas], c64colorpalette)[0]
+
+
+def load_font_atlas(scale: float=1.0, use_cache: bool=True) -> bytes:
+    """Loads the 128 font glyphs as a single scaled atlas image (32 glyphs per row)."""
+    font_data = pkgutil.get_data(__name__, "gfx/font.png") or b""
+    if not use_cache:
+        return _load_font_atlas(font_data, scale)
+    key = diskcache.make_key("font.png", font_data, scale, pillow_version)
+    return diskcache.cached("font_atlas", key, lambda: [_load_font_atlas(font_data, scale)])[0]
+
+
+def atlas_tile_box(index: int, tile_size: int, columns: int) -> Tuple[int, int, int, int]:
+    """Returns the pixel box (x1, y1, x2, y2) of the tile with the given index in an atlas image."""
+    row, col = divmod(index, columns)
+    return col * tile_size, row * tile_size, col * tile_size + tile_size, row * tile_size + tile_size
+
+
+def _scaled_sprite_tiles(tiles_data: bytes, indexed: bool, scale: float) -> Iterator["Image.Image"]:
+    # yields the scaled sprites (palette based images, if indexed)
+    Image = _pil_image()
+    with Image.open(io.BytesIO(tiles_data)) as tile_image:
+        if indexed:
             tile_image = tile_image.copy().convert('P', 0)
             palettevalues = tile_image.getpalette()
             assert 768 - palettevalues.count(0) <= 16, "must be an image with <= 16 colors"
             palette = [(r, g, b) for r, g, b in zip(palettevalues[0:16 * 3:3], palettevalues[1:16 * 3:3], palettevalues[2:16 * 3:3])]
-            pc1 = palette.index((255, 0, 0))        # red, foreground 1
-            pc2 = palette.index((255, 0, 255))      # purple, foreground 2
-            pc3 = palette.index((255, 255, 0))      # yellow, foreground 3 (highlight)
-            pc4 = palette.index((0, 255, 0))        # green, amoeba color
-            pc5 = palette.index((0, 0, 255))        # blue, slime color
-            pc_bg = palette.index((0, 0, 0))        # black, background color
-            assert c64colorpalette
-            palette[pc1] = (c64colorpalette.rgb_fg1 >> 16, (c64colorpalette.rgb_fg1 & 0xff00) >> 8, c64colorpalette.rgb_fg1 & 0xff)
-            palette[pc2] = (c64colorpalette.rgb_fg2 >> 16, (c64colorpalette.rgb_fg2 & 0xff00) >> 8, c64colorpalette.rgb_fg2 & 0xff)
-            palette[pc3] = (c64colorpalette.rgb_fg3 >> 16, (c64colorpalette.rgb_fg3 & 0xff00) >> 8, c64colorpalette.rgb_fg3 & 0xff)
-            palette[pc4] = (c64colorpalette.rgb_amoeba >> 16, (c64colorpalette.rgb_amoeba & 0xff00) >> 8, c64colorpalette.rgb_amoeba & 0xff)
-            palette[pc5] = (c64colorpalette.rgb_slime >> 16, (c64colorpalette.rgb_slime & 0xff00) >> 8, c64colorpalette.rgb_slime & 0xff)
-            palette[pc_bg] = (c64colorpalette.rgb_screen >> 16, (c64colorpalette.rgb_screen & 0xff00) >> 8, c64colorpalette.rgb_screen & 0xff)
-            palettevalues = []
-            for rgb in palette:
-                palettevalues.extend(rgb)
-            tile_image.putpalette(palettevalues)
-        tile_num = 0
+            for key_color in c64_key_colors:
+                if key_color not in palette:
+                    raise IOError("sprites image is missing key color {}".format(key_color))
         if tile_image.width != 128:
             raise IOError("sprites image width should be 8 sprites of 16 pixels = 128 pixels")
+        if tile_image.height != num_sprites // 8 * 16:
+            raise IOError("sprite sheet image should contain {:d} tiles of 16*16 pixels".format(num_sprites))
         scaling_method = Image.NEAREST
         if hasattr(Image, "HAMMING"):
             scaling_method = Image.HAMMING
-        while True:
+        for tile_num in range(num_sprites):
             row, col = divmod(tile_num, 8)
-            if row * 16 >= tile_image.height:
-                break
             ci = tile_image.crop((col * 16, row * 16, col * 16 + 16, row * 16 + 16))
             if scale != 1:
                 ci = ci.resize((int(16 * scale), int(16 * scale)), scaling_method)
-            out = io.BytesIO()
-            ci = ci.convert(mode="P")
-            ci.save(out, "gif")
-            sprite_src_images.append(out.getvalue())
-            tile_num += 1
-    if len(sprite_src_images) != num_sprites:
-        raise IOError("sprite sheet image should contain {:d} tiles of 16*16 pixels".format(num_sprites))
+            yield ci
+
+
+def _load_sprites(tiles_data: bytes, indexed: bool, scale: float) -> Sequence[bytes]:
+    sprite_src_images = []
+    for ci in _scaled_sprite_tiles(tiles_data, indexed, scale):
+        out = io.BytesIO()
+        ci = ci.convert(mode="P")
+        ci.save(out, "gif")
+        sprite_src_images.append(out.getvalue())
     return sprite_src_images
 
 
-def load_font(scale: float=1.0) -> Sequence[bytes]:
-    font_src_images = []
+def _load_sprite_atlas(tiles_data: bytes, indexed: bool, scale: float) -> bytes:
+    # Indexed sprites all share the same palette so they're pasted as-is into a palette based gif image
+    # (that can be recolored). The full color sprites have too many colors for a single gif palette,
+    # they're put in a png image instead (supported by Tk 8.6+).
+    Image = _pil_image()
+    tile_size = int(16 * scale)
+    atlas = None    # type: Any
+    for tile_num, ci in enumerate(_scaled_sprite_tiles(tiles_data, indexed, scale)):
+        if atlas is None:
+            atlas = Image.new("P" if indexed else "RGB", (8 * tile_size, num_sprites // 8 * tile_size))
+            if indexed:
+                atlas.putpalette(ci.getpalette())
+        atlas.paste(ci, atlas_tile_box(tile_num, tile_size, 8))
+    out = io.BytesIO()
+    atlas.save(out, "gif" if indexed else "png")
+    return out.getvalue()
+
+
+def load_font(scale: float=1.0, use_cache: bool=True) -> Sequence[bytes]:
+    font_data = pkgutil.get_data(__name__, "gfx/font.png") or b""
+    if not use_cache:
+        return _load_font(font_data, scale)
+    key = diskcache.make_key("font.png", font_data, scale, pillow_version)
+    return diskcache.cached("font", key, lambda: _load_font(font_data, scale))
+
+
+def _scaled_font_glyphs(font_data: bytes, scale: float) -> Iterator["Image.Image"]:
+    Image = _pil_image()
     scaling_method = Image.NEAREST
     if hasattr(Image, "HAMMING"):
         scaling_method = Image.HAMMING
-    with Image.open(io.BytesIO(pkgutil.get_data(__name__, "gfx/font.png") or b"")) as image:
+    with Image.open(io.BytesIO(font_data)) as image:
         for c in range(0, 128):
             row, col = divmod(c, image.width // 8)       # the font image contains 8x8 pixel tiles
             if row * 8 > image.height:
@@ -183,7 +375,24 @@ def load_font(scale: float=1.0) -> Sequence[bytes]:
             ci = image.crop((col * 8, row * 8, col * 8 + 8, row * 8 + 8))
             if scale != 1:
                 ci = ci.resize((int(8 * scale), int(8 * scale)), scaling_method)
-            out = io.BytesIO()
-            ci.save(out, "gif")
-            font_src_images.append(out.getvalue())
+            yield ci
+
+
+def _load_font(font_data: bytes, scale: float) -> Sequence[bytes]:
+    font_src_images = []
+    for ci in _scaled_font_glyphs(font_data, scale):
+        out = io.BytesIO()
+        ci.save(out, "gif")
+        font_src_images.append(out.getvalue())
     return font_src_images
+
+
+def _load_font_atlas(font_data: bytes, scale: float) -> bytes:
+    Image = _pil_image()
+    glyph_size = int(8 * scale)
+    atlas = Image.new("RGB", (32 * glyph_size, 4 * glyph_size))
+    for c, ci in enumerate(_scaled_font_glyphs(font_data, scale)):
+        atlas.paste(ci, atlas_tile_box(c, glyph_size, 32))
+    out = io.BytesIO()
+    atlas.save(out, "gif")
+    return out.getvalue()
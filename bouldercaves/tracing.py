@@ -0,0 +1,119 @@
+"""
+Boulder Caves - a Boulder Dash (tm) clone.
+
+Lightweight optional tracing of timed spans, for instance of the game logic,
+the screen repaints and the audio mixer, across all threads.
+The trace is written in the Chrome trace event format (json), so it can be
+loaded in chrome://tracing or https://ui.perfetto.dev to see a timeline.
+When tracing is not enabled, the spans do nothing.
+Only the most recent events are kept, so a long session doesn't keep eating memory.
+
+Written by Irmen de Jong (irmen@razorvine.net)
+License: GNU GPL 3.0, see LICENSE
+"""
+
+import os
+import json
+import atexit
+import time
+import functools
+import threading
+from collections import deque
+from typing import Callable, Any
+
+
+enabled = False
+trace_file = ""
+max_events = 200000     # about 10 minutes of a running game
+_events = deque(maxlen=max_events)     # type: deque[dict[str, Any]]
+_thread_names = {}     # type: dict[int, str]
+_pid = os.getpid()
+
+
+def start(filename: str, events: int=max_events) -> None:
+    """
+    Enables tracing, keeping the given number of most recent events.
+    The trace is written to the given file when stop() is called, or when the program exits.
+    """
+    global enabled, trace_file, _events
+    _events = deque(maxlen=events)
+    _thread_names.clear()
+    trace_file = filename
+    enabled = True
+    atexit.register(stop)     # also write the trace if the game crashes
+
+
+def stop() -> None:
+    """Disables tracing and writes the trace file."""
+    global enabled
+    if not enabled:
+        return
+    enabled = False
+    atexit.unregister(stop)
+    metadata = [{"name": "thread_name", "ph": "M", "pid": _pid, "tid": tid, "args": {"name": name}}
+                for tid, name in _thread_names.items()]
+    with open(trace_file, "wt") as out:
+        json.dump({"traceEvents": metadata + list(_events), "displayTimeUnit": "ms"}, out)
+    print("Trace written to", trace_file)
+
+
+def add_span(name: str, category: str, start_time: float, end_time: float) -> None:
+    """Records a span, with start and end times as given by time.perf_counter()."""
+    if not enabled:
+        return
+    tid = threading.get_ident()
+    if tid not in _thread_names:
+        _thread_names[tid] = threading.current_thread().name
+    # appending to a deque is atomic, so no lock is needed when recording from multiple threads
+    _events.append({"name": name, "cat": category, "ph": "X", "pid": _pid, "tid": tid,
+                    "ts": start_time * 1e6, "dur": (end_time - start_time) * 1e6})
+
+
+class _Span:
+    __slots__ = ("name", "category", "start_time")
+
+    def __init__(self, name: str, category: str) -> None:
+        self.name = name
+        self.category = category
+        self.start_time = 0.0
+
+    def __enter__(self) -> "_Span":
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        add_span(self.name, self.category, self.start_time, time.perf_counter())
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self) -> "_NoSpan":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        pass
+
+
+_no_span = _NoSpan()
+
+
+def span(name: str, category: str="game") -> Any:
+    """Context manager that records the time spent in its block as a span (if tracing is enabled)."""
+    return _Span(name, category) if enabled else _no_span
+
+
+def traced(name: str, category: str="game") -> Callable:
+    """Decorator that records every call to the function as a span (if tracing is enabled)."""
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            if not enabled:
+                return func(*args, **kwargs)
+            start_time = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                add_span(name, category, start_time, time.perf_counter())
+        return wrapper
+    return decorator
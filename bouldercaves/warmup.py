@@ -0,0 +1,97 @@
+"""
+Boulder Caves - a Boulder Dash (tm) clone.
+
+Prepares the game's assets (sound samples, synthesized sounds, tile images)
+concurrently in a pool of worker threads, so the game can start as soon as
+the assets it needs first are ready while the rest finishes in the background.
+
+Written by Irmen de Jong (irmen@razorvine.net)
+License: GNU GPL 3.0, see LICENSE
+"""
+
+import os
+import time
+import threading
+import traceback
+import concurrent.futures
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Callable, Iterable, Tuple, Any
+
+
+class AssetWarmup:
+    """
+    Runs asset preparation tasks in a thread pool. Decoding sound files is done by an external
+    process and Pillow releases the GIL for most image operations, so these really run in parallel.
+    """
+    def __init__(self, workers: int=0) -> None:
+        self.executor = ThreadPoolExecutor(max_workers=workers or min(8, (os.cpu_count() or 1) + 2))
+        self.tasks = OrderedDict()    # type: OrderedDict[str, Future]
+
+    def submit(self, name: str, func: Callable, *args: Any, when_done: Callable[[str, Any], None]=None) -> None:
+        """
+        Start a task. If given, when_done(name, result) is called (in the worker thread)
+        when the task completed successfully.
+        """
+        def task() -> Any:
+            result = func(*args)
+            if when_done:
+                when_done(name, result)
+            return result
+        future = self.executor.submit(task)
+        future.add_done_callback(lambda f: self._report_error(name, f))
+        self.tasks[name] = future
+
+    @staticmethod
+    def _report_error(name: str, future: Future) -> None:
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error:
+            print("error preparing asset '{:s}':".format(name))
+            traceback.print_exception(type(error), error, error.__traceback__)
+
+    def progress(self, names: Iterable[str]=()) -> Tuple[int, int]:
+        """Returns (number of tasks done, total number of tasks) of the given tasks (default=all)."""
+        tasks = [self.tasks[name] for name in names] if names else list(self.tasks.values())
+        return sum(1 for task in tasks if task.done()), len(tasks)
+
+    def wait(self, names: Iterable[str], progress: Callable[[int, int], None]=None, interval: float=0.02) -> None:
+        """
+        Waits until the given tasks are done, calling the progress callback regularly
+        (it's called in the waiting thread, so it can update the gui).
+        Raises the exception of a task that failed.
+        """
+        names = list(names)
+        while True:
+            done, total = self.progress(names)
+            if progress:
+                progress(done, total)
+            if done == total:
+                break
+            time.sleep(interval)
+        for name in names:
+            self.tasks[name].result()
+
+    def when_all_done(self, names: Iterable[str], callback: Callable[[], None]) -> None:
+        """Calls the callback (in a background thread) once the given tasks have all completed successfully."""
+        tasks = [self.tasks[name] for name in names]
+
+        def wait_for_tasks() -> None:
+            concurrent.futures.wait(tasks)
+            if not any(task.cancelled() or task.exception() for task in tasks):
+                callback()
+        threading.Thread(target=wait_for_tasks, name="asset-warmup-done", daemon=True).start()
+
+    def result(self, name: str) -> Any:
+        return self.tasks[name].result()
+
+    def shutdown(self, cancel: bool=False) -> None:
+        """
+        Lets the remaining tasks finish in the background. With cancel, the tasks that haven't
+        started yet are cancelled, so only the ones that are already running are waited for at exit.
+        """
+        if cancel:
+            for task in self.tasks.values():
+                task.cancel()
+        self.executor.shutdown(wait=False)